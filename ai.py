@@ -1,11 +1,12 @@
 import os
-import json
 
-import openai
 from dotenv import load_dotenv
 
-from pipeline import MaxPipeline
-from plugins.pagerduty import current_oncalls
+from context_packer import ContextPacker
+from llm import chat_client
+from prompt_registry import registry
+from pipeline import document_id, get_pipeline, on_reindex
+from semantic_cache import SEMANTIC_CACHE_ENABLED, SemanticCache
 
 load_dotenv()
 
@@ -17,85 +18,106 @@ if not OPENAI_TOKEN:
     print("Please set OPENAI_TOKEN in your environment variables.")
     exit()
 
-## Initialize OpenAI
-openai.api_key = OPENAI_TOKEN
-
 oncalls = ""
 
 
 def update_oncalls():
-    print("updating oncalls")
+    from plugins.pagerduty import oncall_cache
+
     global oncalls
-    oncalls = current_oncalls()
+    oncalls = oncall_cache.get()
     return oncalls
 
 
-pipeline = MaxPipeline(openai_token=OPENAI_TOKEN)
+semantic_cache = SemanticCache() if SEMANTIC_CACHE_ENABLED else None
+if semantic_cache:
+    on_reindex(semantic_cache.clear)
 
 
-async def ai_chat_thread(thread):
-    documents = pipeline.retrieve_context(thread[0]["content"])
-    json_docs = json.dumps(
-        [
-            {"page_content": doc.page_content, "metadata": doc.metadata}
-            for doc in documents
-        ],
-        indent=2,
-    )
+DISCLAIMER = "<https://github.com/PostHog/max-ai#disclaimer|Disclaimer> :love-hog:"
 
-    print(json_docs)
-
-    SYSTEM_PROMPT = """
-    You are the trusty PostHog support AI named Max. You are also PostHog's Mascot!
-    Please continue the conversation in a way that is helpful to the user and also makes the user feel like they are talking to a human.
-    Only suggest using PostHog and ClickHouse products or services. HogQL is the same as ClickHouse SQL. Do not suggest products or services from other companies.
-    Please answer the question according to the following context. 
-    Do not create links. Only reference the source from the metadata.source object in the context.
-    If you get a question about pricing please refer to the reasonable and transparent pricing on the pricing page at https://posthog.com/pricing.
-    If you are unsure of the answer, please say "I'm not sure" and encourage the user to ask PostHog staff.
-    Try not to mention <@*> in the response.
-    If you are asked about hoge, please respond with just "We don't talk about Hoge."
-    Do not put the Disclaimer in your response. It will be added automatically.
-    """
+SYSTEM_PROMPT = registry.register("ai.system_prompt", """You are the trusty PostHog support AI named Max. You are also PostHog's Mascot!
+Please continue the conversation in a way that is helpful to the user and also makes the user feel like they are talking to a human.
+Only suggest using PostHog and ClickHouse products or services. HogQL is the same as ClickHouse SQL. Do not suggest products or services from other companies.
+Please answer the question according to the following context.
+Do not create links. Only reference the source from the source line of each document in the context.
+If you get a question about pricing please refer to the reasonable and transparent pricing on the pricing page at https://posthog.com/pricing.
+If you are unsure of the answer, please say "I'm not sure" and encourage the user to ask PostHog staff.
+Try not to mention <@*> in the response.
+If you are asked about hoge, please respond with just "We don't talk about Hoge."
+Do not put the Disclaimer in your response. It will be added automatically.""")
 
-    CONTEXT_PROMPT = f""" 
-    Context:
-    {json_docs}
-    
-    ---
-    
-    Now answer the following question:
-    
+context_packer = ContextPacker(OPENAI_MODEL)
+
+
+async def _prepare_chat(thread):
+    """Retrieves context for the thread and builds the completion prompt.
+
+    Returns (prompt, cache_key, cached_response). cache_key is set when the
+    response should be stored in the semantic cache, and cached_response when
+    it is already there, in which case no prompt is built.
     """
+    pipeline = get_pipeline()
+    # Embedded once for both retrieval and the semantic cache
+    question_vector = await pipeline.embeddings.aembed_query(thread[0]["content"])
+    documents = await pipeline.aretrieve_context(
+        thread[0]["content"], query_vector=question_vector
+    )
 
-    first_message = thread[0]
-    follow_up_thread = thread[1:]
+    # Only standalone questions are cached, follow-ups depend on the whole thread
+    cache_key = None
+    if semantic_cache is not None and len(thread) == 1:
+        cache_key = (question_vector, [document_id(doc) for doc in documents])
+        cached_response = semantic_cache.lookup(*cache_key)
+        if cached_response:
+            print("Semantic cache hit")
+            return None, None, cached_response
 
-    prompt = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "user", "content": CONTEXT_PROMPT + first_message["content"]},
-        *follow_up_thread,
-    ]
+    packed = context_packer.pack(SYSTEM_PROMPT, documents, thread)
+    print(packed.report())
+    return packed.messages, cache_key, None
 
-    completion = openai.ChatCompletion.create(model=OPENAI_MODEL, messages=prompt)
 
-    completion = completion.choices[0].message.content
-    sources = [
-        "https://github.com/PostHog/posthog.com/blob/master/" + doc.metadata["source"]
-        for doc in documents
-    ]
-    sources = "\n".join(sources)
-    disclaimer = "<https://github.com/PostHog/max-ai#disclaimer|Disclaimer> :love-hog:"
+async def ai_chat_thread(thread):
+    prompt, cache_key, cached_response = await _prepare_chat(thread)
+    if cached_response:
+        return cached_response
+
+    completion = await chat_client.complete(OPENAI_MODEL, prompt)
+
     response = f"""{completion}
 
-{disclaimer}
+{DISCLAIMER}
 """
+    if cache_key:
+        semantic_cache.add(*cache_key, response)
     return response
 
 
+async def ai_chat_thread_stream(thread):
+    """Yields the response to the thread as it is generated, ending with the
+    disclaimer. Joined together the chunks equal ai_chat_thread's response."""
+    prompt, cache_key, cached_response = await _prepare_chat(thread)
+    if cached_response:
+        yield cached_response
+        return
+
+    chunks = []
+    async for chunk in chat_client.stream(OPENAI_MODEL, prompt):
+        chunks.append(chunk)
+        yield chunk
+
+    ending = f"""
+
+{DISCLAIMER}
+"""
+    yield ending
+    if cache_key:
+        semantic_cache.add(*cache_key, "".join(chunks) + ending)
+
+
 async def summarize_thread(thread):
     prompt = f"""Summarize this: {thread}"""
-    completion = openai.ChatCompletion.create(
-        model=OPENAI_MODEL, messages=[{"role": "user", "content": prompt}]
+    return await chat_client.complete(
+        OPENAI_MODEL, [{"role": "user", "content": prompt}]
     )
-    return completion.choices[0].message.content
@@ -1,13 +1,59 @@
 import os
 
-import openai
-from dotenv import load_dotenv
+import numpy as np
 
 from inference import OpenAIModel
-
-load_dotenv()  # take environment variables from .env.
-
-openai.api_key = os.environ.get("OPENAI_TOKEN")
+from llm import chat_client
+from mmr import normalize_rows
+from pipeline import get_embedding_index, run_in_thread
+from prompt_registry import registry
+
+LABELS = ("FEATURE FLAGS", "EXPERIMENTS", "OTHERS")
+
+# The local classifier answers when the best label's centroid is at least this
+# much more similar to the question than the runner-up. Below that the LLM
+# decides, unless CLASSIFIER_LLM_FALLBACK=false.
+CLASSIFIER_MIN_MARGIN = float(os.getenv("CLASSIFIER_MIN_MARGIN", 0.02))
+CLASSIFIER_LLM_FALLBACK = os.getenv("CLASSIFIER_LLM_FALLBACK", "true").lower() == "true"
+
+examples = [
+  ("Feature flag called by unique users is greater than daily active users, how is that possible?", "FEATURE FLAGS"),
+  ("How do I get whether a flag is enabled or not?", "FEATURE FLAGS"),
+  ("My feature flags are not working, how do I fix this?", "FEATURE FLAGS"),
+  ("The feature flag isn't loaded early enough on page load, can I bootstrap it?", "FEATURE FLAGS"),
+  ("How do I evaluate feature flags locally in posthog-node?", "FEATURE FLAGS"),
+  ("isFeatureEnabled always returns false for my users", "FEATURE FLAGS"),
+  ("Can I roll out a flag to 20% of users in a cohort?", "FEATURE FLAGS"),
+  ("What does the $feature_flag_called event mean?", "FEATURE FLAGS"),
+  ("How do I reload feature flags after calling identify?", "FEATURE FLAGS"),
+  ("Does getFeatureFlagPayload work with multivariate flags?", "FEATURE FLAGS"),
+  ("How can I avoid calling /decide on every page load for flags?", "FEATURE FLAGS"),
+  ("Can I override a feature flag for a specific user?", "FEATURE FLAGS"),
+  ("My experiment is rolled out to 20% of users, why are there false and none variants?", "EXPERIMENTS"),
+  ("How do I run an A/B test on our marketing homepage?", "EXPERIMENTS"),
+  ("How is statistical significance calculated for experiments?", "EXPERIMENTS"),
+  ("Can I run an experiment without using your feature flag library?", "EXPERIMENTS"),
+  ("How long should I run my experiment before the results are reliable?", "EXPERIMENTS"),
+  ("Why does my experiment say the sample size is too small?", "EXPERIMENTS"),
+  ("Can I change the goal metric of a running experiment?", "EXPERIMENTS"),
+  ("How do I add a third variant to my A/B test?", "EXPERIMENTS"),
+  ("What is the difference between a funnel experiment and a trend experiment?", "EXPERIMENTS"),
+  ("How do I exclude internal users from experiment results?", "EXPERIMENTS"),
+  ("How to create a cohort of users who performed a specific event?", "OTHERS"),
+  ("How do I filter out internal and test users?", "OTHERS"),
+  ("What is the weather like?", "OTHERS"),
+  ("Hi friends I'm feeling great today, do you want to try my new app?", "OTHERS"),
+  ("How do I capture fewer session recordings?", "OTHERS"),
+  ("How do I create an insight?", "OTHERS"),
+  ("How do I update a helm chart?", "OTHERS"),
+  ("What are the types graphs support?", "OTHERS"),
+  ("How much does PostHog cost for 10 million events?", "OTHERS"),
+  ("How do I write a HogQL query to count pageviews by country?", "OTHERS"),
+  ("Who is the support hero this week?", "OTHERS"),
+  ("Can you summarize this thread?", "OTHERS"),
+  ("How do I set up a reverse proxy for the JS snippet?", "OTHERS"),
+  ("Why are my events not showing up in the live events view?", "OTHERS"),
+]
 
 prompt = """
 
@@ -46,20 +92,58 @@ Now classify the question below. Remember to return only one word.
 
 """
 
+registry.register("classification.prompt", prompt)
+
+
+class CentroidClassifier:
+  """Nearest-centroid classifier over question embeddings.
+
+  Each label is represented by the normalized mean of its examples' vectors,
+  so classifying a question is one embedding lookup and a matrix product.
+  """
+
+  def __init__(self, examples, embeddings):
+    self.embeddings = embeddings
+    self.labels = sorted({label for _, label in examples})
+    vectors = normalize_rows(np.array(embeddings.embed_documents([text for text, _ in examples]), dtype=np.float32))
+    self.centroids = normalize_rows(np.array([
+      vectors[[i for i, (_, label) in enumerate(examples) if label == name]].mean(axis=0)
+      for name in self.labels
+    ]))
+
+  def scores(self, vector):
+    return self.centroids @ normalize_rows(np.asarray(vector, dtype=np.float32))
+
+  def predict(self, vector):
+    """Returns (label, margin over the runner-up label)."""
+    scores = self.scores(vector)
+    best, runner_up = np.argsort(-scores)[:2]
+    return self.labels[best], float(scores[best] - scores[runner_up])
+
+
+def get_classifier():
+  return get_embedding_index(
+    "classifier", lambda embeddings: CentroidClassifier(examples, embeddings)
+  )
 
 
 async def classify_question(question, model=OpenAIModel.GPT_3_TURBO.value):
+  classifier = await run_in_thread(get_classifier)
+  label, margin = classifier.predict(await classifier.embeddings.aembed_query(question))
+  if margin >= CLASSIFIER_MIN_MARGIN or not CLASSIFIER_LLM_FALLBACK:
+    return label != "OTHERS"
+
+  print(f"Low confidence classification ({label}, margin {margin:.3f}), asking {model}")
+  return await classify_question_llm(question, model)
+
+
+async def classify_question_llm(question, model=OpenAIModel.GPT_3_TURBO.value):
   messages = [
     {"role": "system", "content": "You are a helpful assistant that answers user queries."},
     {"role": "user", "content": prompt + question},
   ]
 
-  api_response = openai.ChatCompletion.create(
-    model=model,
-    messages=messages
-  )
-
-  classification = api_response["choices"][0]["message"]["content"]
+  classification = await chat_client.complete(model, messages)
 
   return "FEATURE FLAGS" in classification or "EXPERIMENTS" in classification
 
@@ -0,0 +1,211 @@
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from pipeline import get_encoding
+from prompt_registry import registry
+
+# Context window of each chat model, in tokens
+MODEL_CONTEXT_TOKENS = {
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+}
+DEFAULT_CONTEXT_TOKENS = 4096
+
+# Tokens left free in the window for the completion
+COMPLETION_TOKENS = int(os.getenv("CONTEXT_COMPLETION_TOKENS", 1024))
+# Share of the prompt budget held back from retrieved documents for the
+# follow-up thread. The thread also gets whatever the documents leave unused.
+THREAD_TOKEN_SHARE = float(os.getenv("CONTEXT_THREAD_TOKEN_SHARE", 0.3))
+# A document is truncated rather than dropped if at least this many tokens of
+# it fit.
+MIN_DOCUMENT_TOKENS = int(os.getenv("CONTEXT_MIN_DOCUMENT_TOKENS", 64))
+
+# Role and separator tokens the chat format adds around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_PRIMING_TOKENS = 3
+
+SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+|\n{2,}")
+
+CONTEXT_HEADER = registry.register("context_packer.header", "Context:\n")
+CONTEXT_FOOTER = registry.register(
+    "context_packer.footer", "\n---\nNow answer the following question:\n"
+)
+DOCUMENT_SEPARATOR = registry.register("context_packer.separator", "\n\n")
+
+
+def count_tokens(text: str) -> int:
+    """Token count of text, precomputed if it's a registered prompt fragment."""
+    return registry.count(text)
+
+
+def count_message_tokens(messages: List[Dict[str, str]]) -> int:
+    return REPLY_PRIMING_TOKENS + sum(
+        MESSAGE_OVERHEAD_TOKENS + count_tokens(message["content"])
+        for message in messages
+    )
+
+
+def render_document(doc) -> str:
+    """One document as a source line followed by its text, without the JSON
+    quoting, escaping and indentation of the old format."""
+    return f"source: {doc.metadata.get('source', '')}\n{doc.page_content.strip()}"
+
+
+def truncate_text(text: str, max_tokens: int) -> str:
+    """Cuts text down to max_tokens at the last sentence or paragraph boundary
+    that fits, or mid-sentence if not even the first sentence does."""
+    encoding = get_encoding()
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    prefix = encoding.decode(tokens[:max_tokens])
+    boundaries = [match.start() for match in SENTENCE_END_RE.finditer(prefix)]
+    return prefix[: boundaries[-1]] if boundaries else prefix
+
+
+@dataclass
+class PackedContext:
+    messages: List[Dict[str, str]]
+    documents: list
+    tokens_used: int
+    tokens_dropped: int
+    budget: int
+    truncated: List[str] = field(default_factory=list)
+
+    def report(self) -> str:
+        return (
+            f"Context: {self.tokens_used}/{self.budget} tokens used, "
+            f"{self.tokens_dropped} dropped, {len(self.documents)} documents"
+            + (f", truncated {', '.join(self.truncated)}" if self.truncated else "")
+        )
+
+
+class ContextPacker:
+    """Fits a chat prompt into a model's context window.
+
+    The system prompt and the thread's first and latest messages are always
+    kept, the longer of the two truncated first if they alone overflow the
+    window. Retrieved documents fill what is left in ranking order, the last
+    one truncated at a sentence boundary if it doesn't fit whole, except for up
+    to `thread_share` held back for the earlier follow-ups. Those then get all
+    the space the documents didn't use, newest first.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        max_context_tokens: Optional[int] = None,
+        completion_tokens: int = COMPLETION_TOKENS,
+        thread_share: float = THREAD_TOKEN_SHARE,
+    ):
+        self.model = model
+        self.budget = (
+            max_context_tokens or MODEL_CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS)
+        ) - completion_tokens
+        self.thread_share = thread_share
+
+    def pack(
+        self,
+        system_prompt: str,
+        documents: list,
+        thread: List[Dict[str, str]],
+    ) -> PackedContext:
+        first_message, follow_up = thread[0], thread[1:]
+        # The latest message is the one being answered
+        latest = follow_up.pop() if follow_up else None
+        question = first_message["content"]
+        question_tokens = count_tokens(question)
+        fixed = (
+            REPLY_PRIMING_TOKENS
+            + 2 * MESSAGE_OVERHEAD_TOKENS
+            + count_tokens(system_prompt)
+            + count_tokens(CONTEXT_HEADER)
+            + count_tokens(CONTEXT_FOOTER)
+            + question_tokens
+        )
+        if latest is not None:
+            fixed += MESSAGE_OVERHEAD_TOKENS + count_tokens(latest["content"])
+        available = self.budget - fixed
+        dropped = 0
+        truncated = []
+
+        # The longer of the two is cut first, so a long paste in one of them
+        # doesn't truncate the other away
+        kept = {"first message": question}
+        if latest is not None:
+            kept["latest message"] = latest["content"]
+        for name in sorted(kept, key=lambda name: -count_tokens(kept[name])):
+            if available >= 0:
+                break
+            tokens = count_tokens(kept[name])
+            kept[name] = truncate_text(kept[name], max(tokens + available, 0))
+            removed = tokens - count_tokens(kept[name])
+            dropped += removed
+            fixed -= removed
+            available += removed
+            truncated.append(name)
+        question = kept["first message"]
+        if latest is not None:
+            latest = {**latest, "content": kept["latest message"]}
+
+        message_tokens = [
+            MESSAGE_OVERHEAD_TOKENS + count_tokens(message["content"])
+            for message in follow_up
+        ]
+        reserved = min(sum(message_tokens), int(available * self.thread_share))
+        available -= reserved
+
+        rendered = []
+        kept_documents = []
+        separator_tokens = count_tokens(DOCUMENT_SEPARATOR)
+        documents_budget = available
+        for doc in documents:
+            text = render_document(doc)
+            tokens = count_tokens(text) + separator_tokens
+            if tokens <= available:
+                rendered.append(text)
+                kept_documents.append(doc)
+                available -= tokens
+            elif available - separator_tokens >= MIN_DOCUMENT_TOKENS:
+                text = truncate_text(text, available - separator_tokens)
+                kept_tokens = count_tokens(text) + separator_tokens
+                rendered.append(text)
+                kept_documents.append(doc)
+                truncated.append(doc.metadata.get("source", ""))
+                dropped += tokens - kept_tokens
+                available -= kept_tokens
+            else:
+                dropped += tokens
+        documents_tokens = documents_budget - available
+
+        # Newest follow-ups are the most relevant to the answer
+        thread_budget = available + reserved
+        kept_from = len(follow_up)
+        thread_tokens = 0
+        while kept_from and thread_tokens + message_tokens[kept_from - 1] <= thread_budget:
+            kept_from -= 1
+            thread_tokens += message_tokens[kept_from]
+        kept_follow_up = follow_up[kept_from:] + ([latest] if latest is not None else [])
+        dropped += sum(message_tokens[:kept_from])
+
+        context = DOCUMENT_SEPARATOR.join(rendered)
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {
+                "role": "user",
+                "content": CONTEXT_HEADER + context + CONTEXT_FOOTER + question,
+            },
+            *kept_follow_up,
+        ]
+        return PackedContext(
+            messages=messages,
+            documents=kept_documents,
+            tokens_used=fixed + thread_tokens + documents_tokens,
+            tokens_dropped=dropped,
+            budget=self.budget,
+            truncated=truncated,
+        )
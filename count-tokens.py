@@ -1,16 +1,56 @@
-import tiktoken
+"""Reports the token size of every registered static prompt.
 
-from inference import prompt
+    python count-tokens.py [module ...]
 
-encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+Imports the modules that register prompts (all known ones by default) and
+prints each fragment's size, plus the static part of each full prompt.
+"""
+import importlib
+import sys
 
+from prompt_registry import registry
 
-def num_tokens_from_string(string: str, encoding_name: str) -> int:
-    """Returns the number of tokens in a text string."""
-    encoding = tiktoken.get_encoding(encoding_name)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
+PROMPT_MODULES = ["ai", "classification", "context_packer", "inference", "insight_generator"]
 
+# Static parts of the prompts actually sent, by the fragments they're built from
+ASSEMBLED_PROMPTS = {
+    "ai_chat_thread": ["ai.system_prompt", "context_packer.header", "context_packer.footer"],
+    "classify_question": ["classification.prompt"],
+    "get_query_response (gpt-3.5-turbo)": ["inference.prompt", "inference.suffix"],
+    "get_query_response (knowledge retrieval, without docs)": [
+        "inference.instructions",
+        "inference.suffix",
+    ],
+    "get_query_response (gpt-4)": [
+        "inference.prompt",
+        "inference.extended_prompt",
+        "inference.suffix",
+    ],
+    "insight_generator (all built-in events)": ["insight_generator.prompt"],
+    "insight_generator (without definitions)": [
+        "insight_generator.instructions",
+        "insight_generator.examples",
+    ],
+}
 
-# example
-print(num_tokens_from_string(prompt, "cl100k_base"))
\ No newline at end of file
+
+def main(modules):
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except (Exception, SystemExit) as e:
+            print(f"Skipping {module}: {e!r}", file=sys.stderr)
+
+    print(f"{'tokens':>8} {'chars':>8}  fragment")
+    for name, tokens, chars in registry.report():
+        print(f"{tokens:8} {chars:8}  {name}")
+
+    print(f"\n{'tokens':>8}  prompt (static part)")
+    for name, fragments in ASSEMBLED_PROMPTS.items():
+        if all(fragment in registry.fragments for fragment in fragments):
+            _, tokens = registry.assemble(*(registry.fragments[f] for f in fragments))
+            print(f"{tokens:8}  {name}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or PROMPT_MODULES)
@@ -0,0 +1,95 @@
+import json
+import re
+from dataclasses import dataclass
+from typing import List, Tuple
+
+import numpy as np
+from langchain.docstore.document import Document
+
+from lexical_index import BM25Index, reciprocal_rank_fusion
+from mmr import normalize_rows
+
+WORD_RE = re.compile(r"[A-Za-z0-9]+")
+
+
+@dataclass
+class Definition:
+    name: str
+    kind: str  # "event" or "property"
+    description: str = ""
+
+    @property
+    def key(self) -> str:
+        return f"{self.kind}:{self.name}"
+
+    def text(self) -> str:
+        """What gets embedded and indexed: the name, its words spelled out, so
+        "$feature_flag_called" also matches "feature flag called", and the
+        description."""
+        words = " ".join(WORD_RE.findall(self.name.replace("_", " ")))
+        return " - ".join(part for part in (self.name, words, self.description) if part)
+
+
+def load_definitions(path: str) -> List[Definition]:
+    with open(path) as f:
+        return [
+            Definition(
+                name=item["name"],
+                kind=item.get("type", "event"),
+                description=item.get("description") or "",
+            )
+            for item in json.load(f)
+        ]
+
+
+class DefinitionIndex:
+    """Event and property definitions searchable by meaning and by name.
+
+    Definitions are embedded with the pipeline's (cached) embeddings and also
+    kept in an in-memory BM25 index. A search fuses both rankings with
+    reciprocal-rank fusion per kind, so exact names and paraphrases both find
+    the right definitions.
+    """
+
+    def __init__(self, definitions: List[Definition], embeddings):
+        self.definitions = definitions
+        self.embeddings = embeddings
+        self.kinds = np.array([definition.kind for definition in definitions])
+        vectors = np.array(
+            embeddings.embed_documents([d.text() for d in definitions]), dtype=np.float32
+        ).reshape(len(definitions), -1)
+        self.vectors = normalize_rows(vectors)
+        self.positions = {d.key: i for i, d in enumerate(definitions)}
+        self.lexical_index = BM25Index(path=None)
+        self.lexical_index.add(
+            [Document(page_content=d.text()) for d in definitions],
+            [d.key for d in definitions],
+        )
+
+    def search(
+        self, query: str, query_vector: List[float], kind: str, k: int
+    ) -> List[Definition]:
+        fetch_k = max(k * 3, 50)
+        scores = self.vectors @ np.asarray(query_vector, dtype=np.float32)
+        candidates = np.flatnonzero(self.kinds == kind)
+        vector_ranking = [
+            self.definitions[i].key
+            for i in candidates[np.argsort(-scores[candidates])[:fetch_k]]
+        ]
+        lexical_ranking = [
+            key
+            for _, key, _ in self.lexical_index.search(query, fetch_k * 2)
+            if key.startswith(f"{kind}:")
+        ][:fetch_k]
+        fused = reciprocal_rank_fusion([vector_ranking, lexical_ranking])[:k]
+        return [self.definitions[self.positions[key]] for key, _ in fused]
+
+    async def asearch(
+        self, query: str, max_events: int, max_properties: int
+    ) -> Tuple[List[Definition], List[Definition]]:
+        """The most relevant events and properties for the query."""
+        query_vector = await self.embeddings.aembed_query(query)
+        return (
+            self.search(query, query_vector, "event", max_events),
+            self.search(query, query_vector, "property", max_properties),
+        )
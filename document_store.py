@@ -0,0 +1,35 @@
+import os
+
+from langchain.embeddings.base import Embeddings
+
+INDEX_NAME = "Posthog_docs"
+
+# "weaviate" talks to the Weaviate cluster at WEAVIATE_URL (see
+# weaviate_store.py), "local" keeps the index in process (see local_index.py).
+# Each backend's client is only imported when it is used.
+DOCUMENT_STORE = os.getenv("DOCUMENT_STORE", "weaviate")
+
+
+def build_document_store(embeddings: Embeddings, backend: str = DOCUMENT_STORE):
+    if backend == "local":
+        from local_index import LocalDocumentStore
+
+        print("Using local document store")
+        return LocalDocumentStore.load(embeddings)
+
+    import weaviate
+
+    from weaviate_store import WeaviateDocumentStore
+
+    weaviate_auth_config = weaviate.AuthApiKey(api_key=os.getenv("WEAVIATE_API_KEY"))
+    weaviate_client = weaviate.Client(
+        url=os.getenv("WEAVIATE_URL"), auth_client_secret=weaviate_auth_config
+    )
+    return WeaviateDocumentStore(
+        client=weaviate_client,
+        index_name=INDEX_NAME,
+        by_text=False,
+        text_key="page_content",
+        embedding=embeddings,
+        attributes=["source"],
+    )
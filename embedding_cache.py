@@ -0,0 +1,174 @@
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import List
+
+from langchain.embeddings.base import Embeddings
+
+from pipeline import content_hash, run_in_thread
+
+EMBEDDING_CACHE_PATH = os.getenv(
+    "EMBEDDING_CACHE_PATH", os.path.join("data", "embedding_cache.sqlite3")
+)
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", 1024))
+QUERY_EMBEDDING_CACHE_TTL = float(os.getenv("QUERY_EMBEDDING_CACHE_TTL", 3600))
+
+
+class EmbeddingCache:
+    """Disk-backed store of document vectors keyed by (model, sha256 of text)."""
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, hash TEXT NOT NULL, vector BLOB NOT NULL, "
+            "PRIMARY KEY (model, hash))"
+        )
+        self.connection.commit()
+
+    def get_many(self, model: str, hashes: List[str]) -> dict:
+        found = {}
+        with self.lock:
+            # Stay well under SQLite's bound parameter limit
+            for start in range(0, len(hashes), 500):
+                chunk = hashes[start : start + 500]
+                rows = self.connection.execute(
+                    "SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN "
+                    f"({','.join('?' * len(chunk))})",
+                    [model, *chunk],
+                )
+                for key, blob in rows:
+                    found[key] = array("f", blob).tolist()
+        return found
+
+    def put_many(self, model: str, items: dict):
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, hash, vector) VALUES (?, ?, ?)",
+                [
+                    (model, key, array("f", vector).tobytes())
+                    for key, vector in items.items()
+                ],
+            )
+            self.connection.commit()
+
+
+class QueryEmbeddingCache:
+    """In-process LRU cache of query vectors with a time to live."""
+
+    def __init__(
+        self,
+        max_size: int = QUERY_EMBEDDING_CACHE_SIZE,
+        ttl: float = QUERY_EMBEDDING_CACHE_TTL,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, text: str):
+        with self.lock:
+            entry = self.entries.get(text)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[text]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(text)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, text: str, vector: List[float]):
+        with self.lock:
+            self.entries[text] = (time.monotonic() + self.ttl, vector)
+            self.entries.move_to_end(text)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an embedding provider and only sends it texts that are not cached yet."""
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        model: str,
+        cache: EmbeddingCache,
+        query_cache: QueryEmbeddingCache = None,
+    ):
+        self.embeddings = embeddings
+        self.model = model
+        self.cache = cache
+        self.query_cache = query_cache or QueryEmbeddingCache()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes = [content_hash(text) for text in texts]
+        vectors = self.cache.get_many(self.model, list(set(hashes)))
+
+        missing = {}
+        for key, text in zip(hashes, texts):
+            if key not in vectors:
+                missing[key] = text
+        if missing:
+            print(f"Embedding cache: {len(texts) - len(missing)} hits, {len(missing)} misses")
+            embedded = self.embeddings.embed_documents(list(missing.values()))
+            new_vectors = dict(zip(missing.keys(), embedded))
+            self.cache.put_many(self.model, new_vectors)
+            vectors.update(new_vectors)
+
+        return [vectors[key] for key in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = self.query_cache.get(text)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.query_cache.put(text, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        vector = self.query_cache.get(text)
+        if vector is None:
+            vector = await self._aembed_query(text)
+            self.query_cache.put(text, vector)
+        return vector
+
+    async def _aembed_query(self, text: str) -> List[float]:
+        # OpenAIEmbeddings has no async API in this langchain version, but the
+        # openai client it wraps does. Send the request embed_query would send,
+        # retried on rate limits and server errors like embed_with_retry does,
+        # over the chat client's pooled session and concurrency limit.
+        acreate = getattr(getattr(self.embeddings, "client", None), "acreate", None)
+        if acreate is not None and len(text) <= self.embeddings.embedding_ctx_length:
+            from langchain.embeddings.openai import _create_retry_decorator
+
+            from llm import chat_client
+
+            @_create_retry_decorator(self.embeddings)
+            async def create():
+                async with chat_client.pooled():
+                    return await acreate(
+                        input=[text], **self.embeddings._invocation_params
+                    )
+
+            response = await create()
+            return response["data"][0]["embedding"]
+        return await run_in_thread(self.embeddings.embed_query, text)
@@ -0,0 +1,67 @@
+"""Offline accuracy and latency report for the local question classifier.
+
+    python evaluate-classifier.py
+
+Accuracy is leave-one-out over the labelled examples in classification.py:
+each example is classified against centroids built from all the others.
+Latency is measured per question, for the embedding and for the prediction.
+"""
+import time
+
+import numpy as np
+
+from classification import CLASSIFIER_MIN_MARGIN, CentroidClassifier, examples
+from pipeline import get_pipeline
+
+
+def main():
+    embeddings = get_pipeline().embeddings
+    classifier = CentroidClassifier(examples, embeddings)
+
+    correct = confident = confident_correct = 0
+    embed_times, predict_times = [], []
+    confusion = {}
+    for i, (text, label) in enumerate(examples):
+        held_out = CentroidClassifier(examples[:i] + examples[i + 1 :], embeddings)
+
+        embeddings.query_cache.entries.pop(text, None)
+        start = time.perf_counter()
+        vector = embeddings.embed_query(text)
+        embed_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        predicted, margin = held_out.predict(vector)
+        predict_times.append(time.perf_counter() - start)
+
+        correct += predicted == label
+        if margin >= CLASSIFIER_MIN_MARGIN:
+            confident += 1
+            confident_correct += predicted == label
+        confusion[(label, predicted)] = confusion.get((label, predicted), 0) + 1
+
+    total = len(examples)
+    print(f"Examples: {total}")
+    print(f"Leave-one-out accuracy: {correct / total:.1%}")
+    print(
+        f"Answered locally at margin >= {CLASSIFIER_MIN_MARGIN}: {confident / total:.1%}"
+        f" (accuracy {confident_correct / max(confident, 1):.1%}), rest falls back to the LLM"
+    )
+    print("\nConfusion (rows: label, columns: predicted)")
+    print(" " * 14 + "".join(f"{name:>14}" for name in classifier.labels))
+    for label in classifier.labels:
+        print(
+            f"{label:>14}"
+            + "".join(f"{confusion.get((label, name), 0):14}" for name in classifier.labels)
+        )
+    for name, times in (("embed query", embed_times), ("predict", predict_times)):
+        times = np.array(times) * 1000
+        print(
+            f"\n{name} latency: p50 {np.percentile(times, 50):.2f}ms,"
+            f" p95 {np.percentile(times, 95):.2f}ms, max {times.max():.2f}ms",
+            end="",
+        )
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import fcntl
+import os
+from contextlib import contextmanager
+from typing import Callable, Optional, Tuple
+
+
+@contextmanager
+def file_lock(path: str, exclusive: bool = True):
+    """Holds an advisory lock on path + ".lock" across processes, e.g. the
+    gunicorn workers sharing an index on disk. Readers take it shared."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path + ".lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def file_stamp(path: str) -> Optional[Tuple[int, int, int]]:
+    """Identifies the version of a file written with os.replace, or None if
+    it doesn't exist."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def merge_changes(
+    store,
+    reload: Callable[[], None],
+    snapshot: Callable[[list], object],
+    reapply: Callable[[list, object, list], None],
+):
+    """Brings an index shared by several processes up to date and reapplies
+    the ids it changed and hasn't persisted yet on top.
+
+    store.changed holds those ids and store.positions the ones still present.
+    snapshot(updated) saves the rows of the updated ids before reload() reads
+    what other processes persisted, and reapply(updated, rows, deleted) then
+    writes them back. Only the ids changed here stay in store.changed, not the
+    ones reload() applied, so persist() never writes back another process's
+    rows over its later deletes.
+    """
+    changed = set(store.changed)
+    updated = [_id for _id in changed if _id in store.positions]
+    deleted = [_id for _id in changed if _id not in store.positions]
+    rows = snapshot(updated)
+    try:
+        reload()
+        reapply(updated, rows, deleted)
+    finally:
+        store.changed = changed
@@ -0,0 +1,23 @@
+import gc
+import os
+
+bind = "0.0.0.0:8000"
+workers = int(os.getenv("WEB_CONCURRENCY", 4))
+worker_class = "uvicorn.workers.UvicornWorker"
+timeout = 120
+
+# Import the app and load the embedding model in the master, then fork workers
+# that share those pages copy-on-write instead of each loading its own copy.
+# Each worker still builds its own pipeline (store client, caches) lazily.
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+
+    from pipeline import preload_embeddings
+
+    preload_embeddings()
+    # Keep the collector from touching, and so copying, the preloaded objects
+    gc.freeze()
@@ -0,0 +1,48 @@
+import builtins
+import os
+import sys
+import threading
+import time
+
+# Set MAX_IMPORT_TIMING=1 to record how long each module takes to import.
+MAX_IMPORT_TIMING = os.getenv("MAX_IMPORT_TIMING", "").lower() in ("1", "true")
+
+# module name -> (cumulative seconds, seconds excluding nested first imports)
+timings = {}
+
+_original_import = builtins.__import__
+_local = threading.local()
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level or name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+
+    stack = _local.__dict__.setdefault("stack", [])
+    stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.perf_counter() - start
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        timings.setdefault(name, (elapsed, elapsed - nested))
+
+
+def install():
+    builtins.__import__ = _timed_import
+
+
+def install_from_env():
+    if MAX_IMPORT_TIMING:
+        install()
+
+
+def report(limit: int = 30) -> str:
+    rows = sorted(timings.items(), key=lambda item: -item[1][0])[:limit]
+    lines = [f"{'cumulative ms':>14} {'self ms':>9}  module"]
+    for name, (cumulative, own) in rows:
+        lines.append(f"{cumulative * 1000:14.1f} {own * 1000:9.1f}  {name}")
+    return "\n".join(lines)
@@ -1,14 +1,15 @@
 import os
 from enum import Enum
 
-import openai
-from dotenv import load_dotenv
+from llm import chat_client
+from prompt_registry import registry
 
-load_dotenv()  # take environment variables from .env.
+# Send only the sections of the docs below that are relevant to the question,
+# up to a token budget per model, instead of all of them.
+KNOWLEDGE_RETRIEVAL = os.getenv("KNOWLEDGE_RETRIEVAL", "true").lower() == "true"
+KNOWLEDGE_TOKEN_BUDGETS = {"gpt-4": 3000, "gpt-3.5-turbo": 1500}
 
-openai.api_key = os.environ.get("OPENAI_TOKEN")
-
-prompt = """
+instructions = """
 
 You are an assistant that answers users questions. You aim to be as helpful as possible, and only use the information provided below to
 answer the questions.
@@ -19,7 +20,9 @@ Also return the relevant URLS from which you gather this information.
 
 These are all the documents we know of:
 
-Feature Flags
+"""
+
+feature_flag_docs = """Feature Flags
 
 URL: https://posthog.com/docs/feature-flags/manual
 
@@ -585,6 +588,13 @@ The question you have to answer is below. Remember to return URLs to any relevan
 
 """
 
+prompt = instructions + feature_flag_docs
+
+registry.register("inference.prompt", prompt)
+registry.register("inference.instructions", instructions)
+registry.register("inference.extended_prompt", extended_prompt)
+registry.register("inference.suffix", suffix)
+
 
 prompt_1 = """Any recommended best practices for experiments/feature flags that mean we don't spam call the API endpoint every time a page is loaded? Save features into a cookie, then check if that flag is already set, possibly?
 But then are there cases where the value would change for a given user/distinctid?
@@ -607,10 +617,21 @@ class OpenAIModel(Enum):
 
 async def get_query_response(question, follow_up_messages=None, model=OpenAIModel.GPT_3_TURBO.value):
 
-  if model == OpenAIModel.GPT_4.value:
-    full_prompt = prompt + extended_prompt + suffix + question
+  if KNOWLEDGE_RETRIEVAL:
+    from knowledge_index import get_knowledge_index
+    from pipeline import run_in_thread
+
+    index = await run_in_thread(
+      get_knowledge_index, "feature flags", feature_flag_docs + extended_prompt
+    )
+    sections = await index.aretrieve(question, KNOWLEDGE_TOKEN_BUDGETS.get(model, 1500))
+    docs = "\n\n---\n\n".join(section.render() for section in sections)
+    full_prompt, prompt_tokens = registry.assemble(instructions, docs, suffix, question)
+  elif model == OpenAIModel.GPT_4.value:
+    full_prompt, prompt_tokens = registry.assemble(prompt, extended_prompt, suffix, question)
   else:
-    full_prompt = prompt + suffix + question
+    full_prompt, prompt_tokens = registry.assemble(prompt, suffix, question)
+  print(f"Feature flag prompt: {prompt_tokens} tokens")
 
   messages = [
     {"role": "system", "content": "You are a helpful assistant that answers user queries."},
@@ -620,12 +641,7 @@ async def get_query_response(question, follow_up_messages=None, model=OpenAIMode
   if follow_up_messages:
     messages += follow_up_messages
 
-  api_response = openai.ChatCompletion.create(
-    model=model,
-    messages=messages
-  )
-
-  return api_response["choices"][0]["message"]["content"]
+  return await chat_client.complete(model, messages)
 
 
 # print(get_query_response("I want to bootstrap flags, how do I do that?"))
\ No newline at end of file
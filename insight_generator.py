@@ -1,14 +1,43 @@
+import json
 import os
+import re
+from collections import Counter
+from typing import List
 
-import openai
-from dotenv import load_dotenv
+from definition_index import Definition, DefinitionIndex, load_definitions
+from llm import chat_client
+from pipeline import get_embedding_index, run_in_thread
+from prompt_registry import registry
 
-load_dotenv()  # take environment variables from .env.
+# Event and property definitions to pick from, as a JSON list of
+# {"name", "type": "event" | "property", "description"} objects, e.g. exported
+# from a project's data management. Defaults to the built-in lists below.
+INSIGHT_DEFINITIONS_PATH = os.getenv("INSIGHT_DEFINITIONS_PATH")
+# How many of the most relevant events and properties each prompt lists
+INSIGHT_MAX_EVENTS = int(os.getenv("INSIGHT_MAX_EVENTS", 20))
+INSIGHT_MAX_PROPERTIES = int(os.getenv("INSIGHT_MAX_PROPERTIES", 10))
 
-openai.api_key = os.environ.get("OPENAI_TOKEN")
+INSIGHT_MODEL = os.getenv("INSIGHT_MODEL", "gpt-3.5-turbo")
+# Template matches below this confidence go to the LLM instead
+INSIGHT_TEMPLATE_MIN_CONFIDENCE = float(os.getenv("INSIGHT_TEMPLATE_MIN_CONFIDENCE", 0.75))
 
+INSIGHT_TYPES = ("TRENDS", "FUNNELS", "RETENTION", "PATHS", "LIFECYCLE", "STICKINESS")
+INTERVALS = ("hour", "day", "week", "month")
+DISPLAYS = (
+    "ActionsLineGraph",
+    "ActionsLineGraphCumulative",
+    "ActionsTable",
+    "ActionsPie",
+    "ActionsBar",
+    "ActionsBarValue",
+    "WorldMap",
+    "BoldNumber",
+)
+MATHS = ("total", "dau", "weekly_active", "monthly_active")
+DATE_FROM_RE = re.compile(r"^(-\d+[hdwmy](Start)?|dStart|all)$")
 
-prompt = """
+
+instructions = """
 
 You are PostHog's insight assistant that always returns a JSON object for a given insight query.
 
@@ -26,110 +55,266 @@ filter_test_accounts: true or false
 
 ---
 
-The <name of event> can be one of: 
-
-"$feature_flag_called"
-"$autocapture"
-"$pageview"
-"hubspot score updated"
-"$groupidentify"
-"insight refresh time"
-"$identify"
-"None failure"
-"update user properties"
-"organization usage report"
-"insight loaded"
-"billing subscription invoi
-"$pageleave"
-"insight viewed"
-"recording viewed summary"
-"first team event ingested"
-"definition hovered"
-"client_request_failure"
-"cohort updated"
-"$plugin_running_duration"
-"recording list fetched"
-"recording viewed"
-"recording loaded"
-"events table polling paused"
-"insight analyzed"
-"viewed dashboard"
-"events table polling resumed"
-"$capture_failed_request"
-"$capture_metrics"
-"$exception"
-"dashboard loading time"
-"section heading viewed"
-"filters set"
-"recording analyzed"
-"funnel result calculated"
-"dashboard analyzed"
-"dashboard refreshed"
-"$opt_in"
-"recording list properties fetched"
-"person viewed"
-"timezone component viewed"
-"toolbar loaded"
-"$rageclick"
-"$performance_event"
-"entity filter visbility set"
-"recording next recording triggered"
-"dashboard updated"
-"insight timeout message shown"
-"insight person modal viewed"
-"insight saved"
-"filter added"
-"insight created"
-"hubspot contact sync all contac
-"dashboard date range changed"
-"organization usage report failure"
-"event definitions page lo
-"funnel cue 7301 - shown"
-"toolbar mode triggered"
-"billing subscription invoice proj
-"user updated"
-"insight error message shown"
-"instance status report"
-"session recording persist failed"
-"user logged in"
-"hubspot contact sync batch completed"
-"billing subscription paid"
-"local filter removed"
-"billing service usage report failure"
-"toolbar dragged"
-"user instance status report"
-"recording inspector item expanded"
-"experiment viewed"
-"Async migration completed"
-"recording player seekbar e
-"ingestion landing seen"
-"correlation viewed"
-"recording inspector tab viewed"
-"billing v2 shown"
-"feature flag updated"
-"recording events fetched"
-"toolbar selected HTML element"
-"property group filter added"
-"recording list filter added"
-"saved insights list page filter used"
-"team has ingested events"
-"development server launched"
-"correlation interaction"
-"activation sidebar shown"
-"organization quota limits changed"
-"billing alert shown"
-"action updated"
-"dashboard mode toggled"
-"helm_install"
-"recording player speed changed"
-"saved insights list page tab changed"
-"user signed up"
-"correlation properties viewed"
-"web search category refine"
+"""
 
+examples = """
 Here are a few examples:
 
 Show me feature flag called events broken down by the feature flag response
 
 
-"""
\ No newline at end of file
+"""
+
+default_events = [
+    "$feature_flag_called",
+    "$autocapture",
+    "$pageview",
+    "hubspot score updated",
+    "$groupidentify",
+    "insight refresh time",
+    "$identify",
+    "None failure",
+    "update user properties",
+    "organization usage report",
+    "insight loaded",
+    "billing subscription invoi",
+    "$pageleave",
+    "insight viewed",
+    "recording viewed summary",
+    "first team event ingested",
+    "definition hovered",
+    "client_request_failure",
+    "cohort updated",
+    "$plugin_running_duration",
+    "recording list fetched",
+    "recording viewed",
+    "recording loaded",
+    "events table polling paused",
+    "insight analyzed",
+    "viewed dashboard",
+    "events table polling resumed",
+    "$capture_failed_request",
+    "$capture_metrics",
+    "$exception",
+    "dashboard loading time",
+    "section heading viewed",
+    "filters set",
+    "recording analyzed",
+    "funnel result calculated",
+    "dashboard analyzed",
+    "dashboard refreshed",
+    "$opt_in",
+    "recording list properties fetched",
+    "person viewed",
+    "timezone component viewed",
+    "toolbar loaded",
+    "$rageclick",
+    "$performance_event",
+    "entity filter visbility set",
+    "recording next recording triggered",
+    "dashboard updated",
+    "insight timeout message shown",
+    "insight person modal viewed",
+    "insight saved",
+    "filter added",
+    "insight created",
+    "hubspot contact sync all contac",
+    "dashboard date range changed",
+    "organization usage report failure",
+    "event definitions page lo",
+    "funnel cue 7301 - shown",
+    "toolbar mode triggered",
+    "billing subscription invoice proj",
+    "user updated",
+    "insight error message shown",
+    "instance status report",
+    "session recording persist failed",
+    "user logged in",
+    "hubspot contact sync batch completed",
+    "billing subscription paid",
+    "local filter removed",
+    "billing service usage report failure",
+    "toolbar dragged",
+    "user instance status report",
+    "recording inspector item expanded",
+    "experiment viewed",
+    "Async migration completed",
+    "recording player seekbar e",
+    "ingestion landing seen",
+    "correlation viewed",
+    "recording inspector tab viewed",
+    "billing v2 shown",
+    "feature flag updated",
+    "recording events fetched",
+    "toolbar selected HTML element",
+    "property group filter added",
+    "recording list filter added",
+    "saved insights list page filter used",
+    "team has ingested events",
+    "development server launched",
+    "correlation interaction",
+    "activation sidebar shown",
+    "organization quota limits changed",
+    "billing alert shown",
+    "action updated",
+    "dashboard mode toggled",
+    "helm_install",
+    "recording player speed changed",
+    "saved insights list page tab changed",
+    "user signed up",
+    "correlation properties viewed",
+    "web search category refine",
+]
+
+default_properties = [
+    "$browser",
+    "$os",
+    "$device_type",
+    "$current_url",
+    "$pathname",
+    "$referring_domain",
+    "$geoip_country_code",
+    "$feature_flag",
+    "$feature_flag_response",
+    "email",
+]
+
+
+def render_definitions(kind: str, definitions: List[Definition]) -> str:
+    lines = [
+        f'"{definition.name}"'
+        + (f" - {definition.description}" if definition.description else "")
+        for definition in definitions
+    ]
+    return f"The <name of {kind}> can be one of: \n\n" + "\n".join(lines) + "\n"
+
+
+def assemble_prompt(events: List[Definition], properties: List[Definition]) -> str:
+    """The insight prompt listing only the given events and properties."""
+    parts = [instructions, render_definitions("event", events)]
+    if properties:
+        parts.append("\n" + render_definitions("property", properties))
+    parts.append(examples)
+    return "".join(parts)
+
+
+prompt = assemble_prompt([Definition(name, "event") for name in default_events], [])
+
+registry.register("insight_generator.prompt", prompt)
+registry.register("insight_generator.instructions", instructions)
+registry.register("insight_generator.examples", examples)
+
+
+def validate_insight(insight: dict) -> dict:
+    """Checks an insight against the JSON shape the prompt asks for, raising
+    ValueError on the first problem. Both the template and LLM paths go
+    through this before returning anything."""
+    if not isinstance(insight, dict):
+        raise ValueError("Insight must be a JSON object")
+    if insight.get("insight") not in INSIGHT_TYPES:
+        raise ValueError(f"Unknown insight type {insight.get('insight')!r}")
+    if insight.get("interval") not in INTERVALS:
+        raise ValueError(f"Unknown interval {insight.get('interval')!r}")
+    events = insight.get("events")
+    if not isinstance(events, list) or not events:
+        raise ValueError("Insight needs at least one event")
+    for event in events:
+        if not isinstance(event, dict) or not isinstance(event.get("name"), str):
+            raise ValueError(f"Invalid event {event!r}")
+        if event.get("type") != "events" or not isinstance(event.get("order"), int):
+            raise ValueError(f"Invalid event {event!r}")
+        if event.get("math", "total") not in MATHS:
+            raise ValueError(f"Unknown math {event['math']!r}")
+    if "display" in insight and insight["display"] not in DISPLAYS:
+        raise ValueError(f"Unknown display {insight['display']!r}")
+    for prop in insight.get("properties", []):
+        if not isinstance(prop, dict) or not {"key", "value"} <= prop.keys():
+            raise ValueError(f"Invalid property filter {prop!r}")
+    if "date_from" in insight and not DATE_FROM_RE.match(str(insight["date_from"])):
+        raise ValueError(f"Invalid date_from {insight['date_from']!r}")
+    if not isinstance(insight.get("filter_test_accounts", False), bool):
+        raise ValueError("filter_test_accounts must be true or false")
+    if "breakdown" in insight and not isinstance(insight["breakdown"], str):
+        raise ValueError("breakdown must be a property name")
+    return insight
+
+
+_definitions = None
+
+
+def get_definitions() -> List[Definition]:
+    global _definitions
+    if _definitions is None:
+        if INSIGHT_DEFINITIONS_PATH:
+            _definitions = load_definitions(INSIGHT_DEFINITIONS_PATH)
+        else:
+            _definitions = [Definition(name, "event") for name in default_events] + [
+                Definition(name, "property") for name in default_properties
+            ]
+    return _definitions
+
+
+def build_definition_index(embeddings) -> DefinitionIndex:
+    definitions = get_definitions()
+    index = DefinitionIndex(definitions, embeddings)
+    print(f"Indexed {len(definitions)} event and property definitions")
+    return index
+
+
+def get_definition_index() -> DefinitionIndex:
+    return get_embedding_index("definitions", build_definition_index)
+
+
+async def build_insight_prompt(
+    query: str,
+    max_events: int = INSIGHT_MAX_EVENTS,
+    max_properties: int = INSIGHT_MAX_PROPERTIES,
+) -> str:
+    """The insight prompt with only the events and properties most relevant to
+    the query, so its size doesn't grow with the project's catalog."""
+    index = await run_in_thread(get_definition_index)
+    events, properties = await index.asearch(query, max_events, max_properties)
+    return assemble_prompt(events, properties)
+
+
+# How each generate_insight call was answered: "template", "llm", or "invalid"
+# when the LLM's answer failed validation.
+insight_outcomes = Counter()
+
+
+def insight_stats() -> dict:
+    total = sum(insight_outcomes.values())
+    return {
+        **insight_outcomes,
+        "total": total,
+        "template_hit_rate": insight_outcomes["template"] / total if total else None,
+    }
+
+
+async def generate_insight(query: str, model: str = INSIGHT_MODEL) -> dict:
+    """Returns the insight JSON for a request, from the template matcher when
+    it is confident and from the LLM otherwise."""
+    from insight_templates import get_template_matcher
+
+    match = get_template_matcher().match(query)
+    if match is not None and match.confidence >= INSIGHT_TEMPLATE_MIN_CONFIDENCE:
+        try:
+            insight = validate_insight(match.insight)
+            insight_outcomes["template"] += 1
+            print(f"Insight template hit ({match.confidence:.2f}): {query}")
+            return insight
+        except ValueError as e:
+            print(f"Template insight failed validation: {e}")
+
+    prompt = await build_insight_prompt(query)
+    completion = await chat_client.complete(
+        model, [{"role": "user", "content": prompt + query}]
+    )
+    body = completion[completion.find("{") : completion.rfind("}") + 1]
+    try:
+        insight = validate_insight(json.loads(body))
+    except ValueError:
+        insight_outcomes["invalid"] += 1
+        raise
+    insight_outcomes["llm"] += 1
+    return insight
@@ -0,0 +1,228 @@
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from definition_index import Definition
+
+# Words that don't change what an insight request asks for. Every other word
+# in the request has to be explained by a rule below for a confident match.
+STOPWORDS = {
+    "a", "all", "an", "and", "are", "as", "at", "can", "chart", "did", "do",
+    "events", "for", "from", "get", "give", "graph", "how", "i", "in",
+    "insight", "is", "many", "me", "my", "of", "on", "our", "over", "people",
+    "please", "see", "show", "that", "the", "then", "to", "users", "want",
+    "what", "which", "who", "with",
+}
+# Active user counts with no event named are counted on pageviews
+DEFAULT_EVENT = "$pageview"
+WORD_RE = re.compile(r"[$\w]+")
+
+INTENT_RULES = [
+    (r"\bfunnels?\b|\bconver(sion|ts?)\b", "FUNNELS"),
+    (r"\bretention\b|\bretained\b|\bc[oa]me back\b", "RETENTION"),
+    (r"\blifecycle\b", "LIFECYCLE"),
+    (r"\bstickiness\b|\bsticky\b", "STICKINESS"),
+    (r"\b(user )?paths?\b", "PATHS"),
+    (r"\btrends?\b|\bcount\b|\bnumber of\b|\bhow many\b|\bhow often\b", "TRENDS"),
+]
+MATH_RULES = [
+    (r"\b(unique|distinct) (users|visitors|people|persons)\b|\bdau\b|\bdaily active users\b", "dau"),
+    (r"\bweekly active users\b|\bwau\b", "weekly_active"),
+    (r"\bmonthly active users\b|\bmau\b", "monthly_active"),
+    (r"\btotal\b", "total"),
+]
+INTERVAL_RE = re.compile(
+    r"\b(per|by|each|every|a) (?P<unit>hour|day|week|month)\b|\b(?P<adverb>hourly|daily|weekly|monthly)\b"
+)
+ADVERB_INTERVALS = {"hourly": "hour", "daily": "day", "weekly": "week", "monthly": "month"}
+DATE_RANGE_RE = re.compile(
+    r"\b((in|for|over|during) )?(the )?(last|past|previous) ((?P<count>\d+) )?"
+    r"(?P<unit>hour|day|week|month|year)s?\b"
+)
+DISPLAY_RULES = [
+    (r"\b(as|in) a table\b|\btable\b", "ActionsTable"),
+    (r"\bpie( chart)?\b", "ActionsPie"),
+    (r"\bbar (chart|graph)\b|\bbars\b", "ActionsBar"),
+    (r"\bworld map\b|\bon a map\b", "WorldMap"),
+    (r"\bcumulative(ly)?\b", "ActionsLineGraphCumulative"),
+    (r"\b(as a )?(single |big )?number\b", "BoldNumber"),
+    (r"\bline (chart|graph)\b", "ActionsLineGraph"),
+]
+TEST_ACCOUNTS_RE = re.compile(
+    r"\b(excluding|exclude|without|filter(ing)? out|ignoring|ignore) "
+    r"(internal and test|test and internal|test|internal)( users| accounts)?\b"
+)
+# Words the rules can't represent that change what is asked, rather than
+# just being unexplained. Left over after the rules ran, they send the
+# request to the LLM whatever its confidence.
+NEGATION_RE = re.compile(
+    r"\b(not|no|never|without|except|excluding|exclude|other than|non)\b|n't\b"
+)
+TIME_RE = re.compile(
+    r"\b(today|yesterday|tonight|now|this (hour|day|week|month|quarter|year)|"
+    r"last|past|previous|since|until|between|before|after|ago|"
+    r"quarter|q[1-4]|ytd|year to date|\d{4}|"
+    r"jan(uary)?|feb(ruary)?|mar(ch)?|apr(il)?|may|june?|july?|aug(ust)?|"
+    r"sep(tember)?|oct(ober)?|nov(ember)?|dec(ember)?|"
+    r"(mon|tues|wednes|thurs|fri|satur|sun)day)\b"
+)
+
+# Everyday names for common events and properties
+EVENT_ALIASES = {
+    "$pageview": ["pageview", "page view", "visit"],
+    "$pageleave": ["pageleave", "page leave"],
+    "$autocapture": ["autocapture", "click"],
+    "$identify": ["identify", "identification"],
+    "user signed up": ["signup", "sign up", "signed up", "registration"],
+}
+PROPERTY_ALIASES = {
+    "$browser": ["browser"],
+    "$os": ["os", "operating system"],
+    "$device_type": ["device", "device type"],
+    "$current_url": ["url", "current url"],
+    "$pathname": ["path", "pathname", "page"],
+    "$referring_domain": ["referrer", "referring domain"],
+    "$geoip_country_code": ["country"],
+    "$feature_flag_response": ["flag response", "feature flag response", "variant"],
+}
+
+
+@dataclass
+class TemplateMatch:
+    insight: dict
+    # Share of the request's content words that the template accounted for
+    confidence: float
+
+
+def name_phrases(name: str, aliases: Dict[str, List[str]]) -> set:
+    words = " ".join(re.findall(r"[a-z0-9]+", name.lower().replace("_", " ")))
+    return {name.lower(), words, *aliases.get(name, [])} - {""}
+
+
+def phrase_regex(phrases: Dict[str, str]) -> re.Pattern:
+    """One alternation over all phrases, longest first, allowing a plural s."""
+    alternation = "|".join(
+        re.escape(phrase) for phrase in sorted(phrases, key=len, reverse=True)
+    )
+    return re.compile(rf"(?<![\w$])(?:{alternation})s?(?!\w)")
+
+
+class InsightTemplateMatcher:
+    """Recognizes simple insight requests and builds their JSON without an LLM.
+
+    Rules pick out the insight type, the math, an interval, a date range, a
+    display, a breakdown and test account filtering, and known event names
+    (including everyday aliases like "pageviews") from the request. Each rule
+    masks the text it consumed, and the match's confidence is the share of
+    the remaining content words it consumed, so requests with parts the
+    rules don't understand fall through to the LLM.
+    """
+
+    def __init__(self, definitions: List[Definition]):
+        self.definitions = definitions
+        self.event_phrases = {}
+        self.property_phrases = {}
+        for definition in definitions:
+            if definition.kind == "event":
+                target, aliases = self.event_phrases, EVENT_ALIASES
+            else:
+                target, aliases = self.property_phrases, PROPERTY_ALIASES
+            for phrase in name_phrases(definition.name, aliases):
+                target.setdefault(phrase, definition.name)
+        self.event_re = phrase_regex(self.event_phrases)
+        self.breakdown_re = re.compile(
+            r"\b((broken|break|split|segmented|grouped) ?(down )?)?by (the )?(?P<property>"
+            + phrase_regex(self.property_phrases).pattern
+            + r")"
+        )
+
+    def match(self, query: str) -> Optional[TemplateMatch]:
+        text = query.lower()
+        covered = [False] * len(text)
+
+        def consume(pattern, flags=0):
+            matches = []
+            masked = "".join(" " if c else ch for ch, c in zip(text, covered))
+            for found in re.finditer(pattern, masked, flags):
+                for i in range(found.start(), found.end()):
+                    covered[i] = True
+                matches.append(found)
+            return matches
+
+        # Rules run most specific first, so e.g. "daily active users" is read
+        # as math before "daily" can be read as an interval
+        insight = {}
+        math = next((name for pattern, name in MATH_RULES if consume(pattern)), None)
+        for found in consume(DATE_RANGE_RE)[:1]:
+            unit = found.group("unit")[0]
+            insight["date_from"] = f"-{found.group('count') or 1}{unit}"
+        for found in consume(INTERVAL_RE)[:1]:
+            insight["interval"] = found.group("unit") or ADVERB_INTERVALS[found.group("adverb")]
+        if consume(TEST_ACCOUNTS_RE):
+            insight["filter_test_accounts"] = True
+        for found in consume(self.breakdown_re)[:1]:
+            phrase = found.group("property")
+            insight["breakdown"] = self.property_phrases.get(
+                phrase, self.property_phrases.get(phrase[:-1])
+            )
+            insight["breakdown_type"] = "event"
+        intent = next(
+            (name for pattern, name in INTENT_RULES if consume(pattern)), "TRENDS"
+        )
+        for pattern, display in DISPLAY_RULES:
+            if consume(pattern):
+                insight["display"] = display
+                break
+
+        events = []
+        for found in consume(self.event_re):
+            phrase = found.group()
+            name = self.event_phrases.get(phrase, self.event_phrases.get(phrase[:-1]))
+            if name not in events:
+                events.append(name)
+
+        masked = "".join(" " if c else ch for ch, c in zip(text, covered))
+        if NEGATION_RE.search(masked) or TIME_RE.search(masked):
+            return None
+
+        if not events and math in ("dau", "weekly_active", "monthly_active"):
+            events.append(DEFAULT_EVENT)
+        if not events or (intent == "FUNNELS" and len(events) < 2):
+            return None
+
+        content_words = 0
+        explained_words = 0
+        for found in WORD_RE.finditer(text):
+            if found.group() in STOPWORDS:
+                continue
+            content_words += 1
+            explained_words += all(covered[found.start() : found.end()])
+
+        insight = {
+            "insight": intent,
+            "interval": insight.pop("interval", "day"),
+            "events": [
+                {
+                    "name": name,
+                    "type": "events",
+                    "order": order,
+                    **({"math": math} if math else {}),
+                }
+                for order, name in enumerate(events)
+            ],
+            **insight,
+        }
+        return TemplateMatch(insight, explained_words / max(content_words, 1))
+
+
+_matcher = None
+
+
+def get_template_matcher() -> InsightTemplateMatcher:
+    global _matcher
+    from insight_generator import get_definitions
+
+    definitions = get_definitions()
+    if _matcher is None or _matcher.definitions is not definitions:
+        _matcher = InsightTemplateMatcher(definitions)
+    return _matcher
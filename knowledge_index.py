@@ -0,0 +1,110 @@
+import re
+from dataclasses import dataclass
+from typing import List
+
+import numpy as np
+
+from context_packer import count_tokens, truncate_text
+from mmr import normalize_rows
+from pipeline import get_embedding_index
+
+SECTION_SEPARATOR_RE = re.compile(r"^---\s*$", re.MULTILINE)
+URL_LINE_RE = re.compile(r"^URL:\s*(\S+)\s*$", re.MULTILINE)
+
+
+@dataclass
+class KnowledgeChunk:
+    title: str
+    url: str
+    text: str
+    position: int
+    tokens: int = 0
+
+    def render(self) -> str:
+        return f"{self.title}\nURL: {self.url}\n\n{self.text}"
+
+
+def split_sections(text: str, max_tokens: int = 400) -> List[KnowledgeChunk]:
+    """Splits a hand-written knowledge dump into chunks.
+
+    Sections are separated by `---` lines and carry a `URL:` line, with the
+    lines above it as their title. Sections longer than max_tokens are split
+    between paragraphs, each part keeping the section's title and URL.
+    """
+    chunks = []
+    for block in SECTION_SEPARATOR_RE.split(text):
+        match = URL_LINE_RE.search(block)
+        if match is None:
+            continue
+        title = " - ".join(
+            line.strip() for line in block[: match.start()].splitlines() if line.strip()
+        )
+        url = match.group(1)
+        paragraphs = [p.strip() for p in block[match.end() :].split("\n\n") if p.strip()]
+
+        part = []
+        part_tokens = 0
+        for paragraph in paragraphs:
+            tokens = count_tokens(paragraph)
+            if part and part_tokens + tokens > max_tokens:
+                chunks.append(KnowledgeChunk(title, url, "\n\n".join(part), len(chunks)))
+                part, part_tokens = [], 0
+            part.append(paragraph)
+            part_tokens += tokens
+        if part:
+            chunks.append(KnowledgeChunk(title, url, "\n\n".join(part), len(chunks)))
+
+    for chunk in chunks:
+        chunk.tokens = count_tokens(chunk.render())
+    return chunks
+
+
+class KnowledgeIndex:
+    """In-memory vector index over the chunks of a static knowledge dump.
+
+    Chunks are embedded with the pipeline's embeddings, so their vectors come
+    from the same model as query vectors and are cached on disk across
+    restarts.
+    """
+
+    def __init__(self, chunks: List[KnowledgeChunk], embeddings):
+        self.chunks = chunks
+        self.embeddings = embeddings
+        vectors = np.array(
+            embeddings.embed_documents([chunk.render() for chunk in chunks]),
+            dtype=np.float32,
+        ).reshape(len(chunks), -1)
+        self.vectors = normalize_rows(vectors)
+
+    def search(self, query_vector: List[float], max_tokens: int) -> List[KnowledgeChunk]:
+        """The most similar chunks that fit in max_tokens, in their original
+        order. The best chunk is truncated rather than left out if it alone is
+        over budget."""
+        scores = self.vectors @ np.asarray(query_vector, dtype=np.float32)
+        selected = []
+        remaining = max_tokens
+        for i in np.argsort(-scores):
+            chunk = self.chunks[i]
+            if chunk.tokens <= remaining:
+                selected.append(chunk)
+                remaining -= chunk.tokens
+            elif not selected:
+                header_tokens = count_tokens(f"{chunk.title}\nURL: {chunk.url}\n\n")
+                text = truncate_text(chunk.text, max_tokens - header_tokens)
+                selected.append(KnowledgeChunk(chunk.title, chunk.url, text, chunk.position))
+                break
+        return sorted(selected, key=lambda chunk: chunk.position)
+
+    async def aretrieve(self, query: str, max_tokens: int) -> List[KnowledgeChunk]:
+        return self.search(await self.embeddings.aembed_query(query), max_tokens)
+
+
+def get_knowledge_index(name: str, text: str) -> KnowledgeIndex:
+    """The index over the sections of `text`, shared under `name`."""
+
+    def build(embeddings):
+        index = KnowledgeIndex(split_sections(text), embeddings)
+        print(f"Indexed {len(index.chunks)} {name} knowledge chunks")
+        return index
+
+    return get_embedding_index(f"knowledge:{name}", build)
@@ -0,0 +1,311 @@
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain.docstore.document import Document
+
+from file_lock import file_lock, file_stamp, merge_changes
+
+LEXICAL_INDEX_PATH = os.getenv(
+    "LEXICAL_INDEX_PATH", os.path.join("data", "lexical_index.json")
+)
+
+# persist() appends the changes since the last one as a segment, and rewrites
+# the whole index as a new base once this many segments have piled up.
+LEXICAL_INDEX_MAX_SEGMENTS = int(os.getenv("LEXICAL_INDEX_MAX_SEGMENTS", 32))
+
+# Identifiers such as $feature_flag_called, posthog.capture or toStartOfDay are
+# kept whole and also split into their parts, so both exact and partial
+# mentions match.
+TOKEN_RE = re.compile(r"[$\w]+(?:[.:][$\w]+)*")
+PART_RE = re.compile(r"[A-Z]?[a-z0-9]+|[A-Z]+(?![a-z])")
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for match in TOKEN_RE.finditer(text):
+        token = match.group()
+        tokens.append(token.lower())
+        parts = PART_RE.findall(token)
+        if len(parts) > 1:
+            tokens += [part.lower() for part in parts]
+    return tokens
+
+
+def reciprocal_rank_fusion(
+    rankings: Iterable[List[str]], k: int = 60
+) -> List[Tuple[str, float]]:
+    """Fuses ranked lists of keys, scoring each key by sum(1 / (k + rank))."""
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, key in enumerate(ranking):
+            scores[key] += 1 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: -item[1])
+
+
+class BM25Index:
+    """Okapi BM25 over an inverted index of postings arrays.
+
+    Postings are appended to per-term lists as documents are added and frozen
+    into (doc positions, term frequencies) NumPy arrays on the first search that
+    needs them, so a query only touches the postings of its own terms. Deleted
+    documents are tombstoned and dropped on the next load.
+
+    Every gunicorn worker holds its own index. Like the local store, it is
+    persisted as a base file plus segments holding the changes of each later
+    persist(), named by a manifest, so a search only applies the segments
+    other processes wrote since. An index without a path lives only in memory.
+    """
+
+    def __init__(self, path: str = LEXICAL_INDEX_PATH, k1: float = 1.2, b: float = 0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.lock = threading.RLock()
+        # Base generation and segments on disk this index has applied, and the
+        # version of the manifest naming them
+        self.loaded = False
+        self.generation = None
+        self.segments = 0
+        self.stamp = None
+        # Ids added or deleted here and not persisted yet
+        self.changed = set()
+        self._clear()
+
+    def _clear(self):
+        self.ids = []
+        self.texts = []
+        self.metadatas = []
+        # Per position, grown geometrically like the local store's matrix
+        self.lengths = np.zeros(0, dtype=np.float32)
+        self.alive = np.zeros(0, dtype=bool)
+        self.positions = {}
+        self.pending: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        self.postings: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self.total_length = 0
+
+    @classmethod
+    def load(cls, path: str = LEXICAL_INDEX_PATH, **kwargs) -> "BM25Index":
+        index = cls(path, **kwargs)
+        index.refresh()
+        if len(index):
+            print(f"Loaded {len(index)} documents into the lexical index")
+        return index
+
+    def refresh(self):
+        """Applies what other processes persisted since this index last read
+        or wrote it, usually just their new segments."""
+        if self.path is None:
+            return
+        with self.lock:
+            if self.loaded and file_stamp(self._manifest_path()) == self.stamp:
+                return
+            with file_lock(self._manifest_path(), exclusive=False):
+                self._reload()
+
+    def _manifest_path(self) -> str:
+        return self.path + ".manifest.json"
+
+    def _segment_path(self, number: int) -> str:
+        return os.path.join(self.path + ".segments", f"{number:06d}.json")
+
+    def _read_manifest(self) -> Optional[dict]:
+        if os.path.exists(self._manifest_path()):
+            with open(self._manifest_path()) as f:
+                return json.load(f)
+        # Written before segments existed
+        if os.path.exists(self.path):
+            return {"generation": 0, "segments": 0}
+        return None
+
+    def _reload(self):
+        """Catches up with the index on disk and reapplies the changes made here
+        that aren't persisted yet. Expects the file lock held."""
+        stamp = file_stamp(self._manifest_path())
+        if self.loaded and stamp == self.stamp:
+            return
+        self.loaded = True
+        self.stamp = stamp
+        manifest = self._read_manifest()
+        if manifest is None:
+            return
+        merge_changes(
+            self, lambda: self._catch_up(manifest), self._snapshot, self._reapply
+        )
+
+    def _catch_up(self, manifest: dict):
+        """Reads the base if it was rewritten and applies the newer segments."""
+        if manifest["generation"] != self.generation:
+            with open(self.path) as f:
+                documents = json.load(f)
+            self._clear()
+            self._add_rows(documents)
+            self.generation = manifest["generation"]
+            self.segments = 0
+        for number in range(self.segments + 1, manifest["segments"] + 1):
+            with open(self._segment_path(number)) as f:
+                segment = json.load(f)
+            self.delete(segment["deleted"])
+            self._add_rows(segment)
+        self.segments = manifest["segments"]
+
+    def _add_rows(self, rows: dict):
+        self.add(
+            [
+                Document(page_content=text, metadata=metadata)
+                for text, metadata in zip(rows["texts"], rows["metadatas"])
+            ],
+            rows["ids"],
+        )
+
+    def _snapshot(self, ids: List[str]) -> List[Document]:
+        return [self._document(self.positions[_id]) for _id in ids]
+
+    def _reapply(self, updated: List[str], documents: List[Document], deleted: List[str]):
+        self.delete(deleted)
+        self.add(documents, updated)
+
+    def persist(self):
+        with self.lock, file_lock(self._manifest_path()):
+            self._reload()
+            if not self.changed:
+                return
+            replaced_segments = 0
+            if self.generation is None or self.segments >= LEXICAL_INDEX_MAX_SEGMENTS:
+                replaced_segments = self.segments
+                self._write_base()
+            else:
+                self._write_segment(self.segments + 1)
+            with open(self._manifest_path() + ".tmp", "w") as f:
+                json.dump({"generation": self.generation, "segments": self.segments}, f)
+            os.replace(self._manifest_path() + ".tmp", self._manifest_path())
+            self.stamp = file_stamp(self._manifest_path())
+            self.changed = set()
+            # Only unreferenced once the manifest names the new base
+            for number in range(1, replaced_segments + 1):
+                os.remove(self._segment_path(number))
+
+    def _write_segment(self, number: int):
+        """Writes the documents changed since the last persist and the deleted ids."""
+        updated = [_id for _id in self.changed if _id in self.positions]
+        path = self._segment_path(number)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "ids": updated,
+                    "texts": [self.texts[self.positions[_id]] for _id in updated],
+                    "metadatas": [self.metadatas[self.positions[_id]] for _id in updated],
+                    "deleted": [_id for _id in self.changed if _id not in self.positions],
+                },
+                f,
+            )
+        self.segments = number
+
+    def _write_base(self):
+        """Rewrites the live documents as a new generation."""
+        live = np.flatnonzero(self.alive[: len(self.ids)])
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(
+                {
+                    "ids": [self.ids[i] for i in live],
+                    "texts": [self.texts[i] for i in live],
+                    "metadatas": [self.metadatas[i] for i in live],
+                },
+                f,
+            )
+        os.replace(self.path + ".tmp", self.path)
+        self.generation = (self.generation or 0) + 1
+        self.segments = 0
+
+    def __len__(self):
+        return len(self.positions)
+
+    def add(self, documents: List[Document], ids: List[str]):
+        with self.lock:
+            self.delete([_id for _id in ids if _id in self.positions])
+            self.changed.update(ids)
+            self._reserve(len(ids))
+            for doc, _id in zip(documents, ids):
+                position = len(self.ids)
+                terms = Counter(tokenize(doc.page_content))
+                for term, count in terms.items():
+                    self.pending[term].append((position, count))
+                length = sum(terms.values())
+                self.ids.append(_id)
+                self.texts.append(doc.page_content)
+                self.metadatas.append(dict(doc.metadata))
+                self.lengths[position] = length
+                self.alive[position] = True
+                self.positions[_id] = position
+                self.total_length += length
+
+    def delete(self, ids: List[str]):
+        with self.lock:
+            self.changed.update(ids)
+            for _id in ids:
+                position = self.positions.pop(_id, None)
+                if position is not None:
+                    self.alive[position] = False
+                    self.total_length -= int(self.lengths[position])
+
+    def _reserve(self, rows: int):
+        size = len(self.ids)
+        if len(self.alive) >= size + rows:
+            return
+        capacity = max(size + rows, 2 * size, 1024)
+        lengths = np.zeros(capacity, dtype=np.float32)
+        lengths[:size] = self.lengths[:size]
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:size] = self.alive[:size]
+        self.lengths, self.alive = lengths, alive
+
+    def _postings(self, term: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        pending = self.pending.pop(term, None)
+        if pending:
+            positions, counts = zip(*pending)
+            frozen = self.postings.get(term)
+            positions = np.array(positions, dtype=np.int32)
+            counts = np.array(counts, dtype=np.float32)
+            if frozen is not None:
+                positions = np.concatenate([frozen[0], positions])
+                counts = np.concatenate([frozen[1], counts])
+            self.postings[term] = (positions, counts)
+        return self.postings.get(term)
+
+    def search(self, query: str, k: int = 20) -> List[Tuple[Document, str, float]]:
+        self.refresh()
+        with self.lock:
+            if not self.positions:
+                return []
+            alive, lengths = self.alive, self.lengths
+            average_length = self.total_length / len(self.positions) or 1
+            scores = np.zeros(len(self.ids), dtype=np.float32)
+            for term in set(tokenize(query)):
+                postings = self._postings(term)
+                if postings is None:
+                    continue
+                positions, counts = postings
+                live = alive[positions]
+                positions, counts = positions[live], counts[live]
+                if not len(positions):
+                    continue
+                idf = math.log(
+                    1 + (len(self.positions) - len(positions) + 0.5) / (len(positions) + 0.5)
+                )
+                norm = self.k1 * (1 - self.b + self.b * lengths[positions] / average_length)
+                scores[positions] += idf * counts * (self.k1 + 1) / (counts + norm)
+
+            matched = np.flatnonzero(scores)
+            top = matched[np.argsort(-scores[matched])[:k]]
+            return [(self._document(i), self.ids[i], float(scores[i])) for i in top]
+
+    def _document(self, position: int) -> Document:
+        return Document(
+            page_content=self.texts[position], metadata=dict(self.metadatas[position])
+        )
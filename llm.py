@@ -0,0 +1,137 @@
+import asyncio
+import os
+import re
+import weakref
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+OPENAI_TOKEN = os.environ.get("OPENAI_TOKEN")
+
+# Completions in flight per process. Callers beyond this wait for a slot rather
+# than piling more requests onto the OpenAI rate limit.
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", 16))
+# Keep-alive connections to the OpenAI API per process
+OPENAI_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", 32))
+
+# Request timeouts in seconds per model. Override one with e.g.
+# OPENAI_TIMEOUT_GPT_4=90, or the fallback for other models with OPENAI_TIMEOUT.
+OPENAI_TIMEOUTS = {"gpt-4": 120, "gpt-3.5-turbo": 30}
+OPENAI_DEFAULT_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", 60))
+
+
+def model_timeout(model: str) -> float:
+    variable = "OPENAI_TIMEOUT_" + re.sub(r"\W", "_", model).upper()
+    return float(
+        os.getenv(variable, OPENAI_TIMEOUTS.get(model, OPENAI_DEFAULT_TIMEOUT))
+    )
+
+
+class ChatClient:
+    """Async chat completions over a shared, pooled HTTP session.
+
+    openai's acreate opens a new aiohttp session for every request unless one is
+    set on `openai.aiosession`, so each call here runs with a long-lived session
+    whose connector keeps connections alive. aiohttp sessions and asyncio
+    semaphores belong to one event loop, so both are created per loop.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = OPENAI_MAX_CONCURRENCY,
+        pool_size: int = OPENAI_POOL_SIZE,
+    ):
+        self.max_concurrency = max_concurrency
+        self.pool_size = pool_size
+        self.loops = weakref.WeakKeyDictionary()
+
+    def _loop_state(self):
+        import aiohttp
+
+        loop = asyncio.get_running_loop()
+        state = self.loops.get(loop)
+        if state is None or state[0].closed:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            )
+            state = (session, asyncio.Semaphore(self.max_concurrency))
+            self.loops[loop] = state
+        return state
+
+    @asynccontextmanager
+    async def pooled(self):
+        """Holds a concurrency slot and sends the openai requests made inside,
+        e.g. query embeddings, over the shared session."""
+        import openai
+
+        session, semaphore = self._loop_state()
+        async with semaphore:
+            token = openai.aiosession.set(session)
+            try:
+                yield
+            finally:
+                openai.aiosession.reset(token)
+
+    async def create(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        timeout: Optional[float] = None,
+        **kwargs,
+    ):
+        import openai
+
+        async with self.pooled():
+            return await openai.ChatCompletion.acreate(
+                model=model,
+                messages=messages,
+                api_key=OPENAI_TOKEN,
+                request_timeout=timeout or model_timeout(model),
+                **kwargs,
+            )
+
+    async def stream(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        timeout: Optional[float] = None,
+        **kwargs,
+    ):
+        """Yields the content of the first choice as it is generated. The
+        concurrency slot is held until the stream is exhausted or closed."""
+        import openai
+
+        session, semaphore = self._loop_state()
+        async with semaphore:
+            token = openai.aiosession.set(session)
+            try:
+                response = await openai.ChatCompletion.acreate(
+                    model=model,
+                    messages=messages,
+                    api_key=OPENAI_TOKEN,
+                    request_timeout=timeout or model_timeout(model),
+                    stream=True,
+                    **kwargs,
+                )
+            finally:
+                openai.aiosession.reset(token)
+            async for chunk in response:
+                content = chunk["choices"][0]["delta"].get("content")
+                if content:
+                    yield content
+
+    async def complete(self, model: str, messages: List[Dict[str, str]], **kwargs) -> str:
+        """Returns the content of the first choice."""
+        response = await self.create(model, messages, **kwargs)
+        return response["choices"][0]["message"]["content"]
+
+    async def close(self):
+        state = self.loops.pop(asyncio.get_running_loop(), None)
+        if state is not None:
+            await state[0].close()
+
+
+chat_client = ChatClient()
@@ -0,0 +1,176 @@
+import atexit
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import List
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+LOCAL_EMBEDDING_MODEL = os.getenv("LOCAL_EMBEDDING_MODEL", "all-mpnet-base-v2")
+LOCAL_EMBEDDING_WORKERS = int(os.getenv("LOCAL_EMBEDDING_WORKERS", os.cpu_count() or 1))
+LOCAL_EMBEDDING_BATCH_SIZE = int(os.getenv("LOCAL_EMBEDDING_BATCH_SIZE", 32))
+
+# "default" runs the sentence-transformers model as is, "int8" applies dynamic
+# int8 quantization to its linear layers and "onnx" runs an ONNX export of it
+# through onnxruntime (needs `optimum[onnxruntime]`).
+LOCAL_EMBEDDING_VARIANT = os.getenv("LOCAL_EMBEDDING_VARIANT", "default")
+
+# Model loaded by each pool worker, and by the parent process for queries
+_model = None
+
+
+class OnnxEncoder:
+    """Mean-pooled, normalized sentence embeddings from an ONNX export, matching
+    the output of the sentence-transformers Pooling + Normalize modules."""
+
+    def __init__(self, model_name: str):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        model_id = f"sentence-transformers/{model_name}"
+        self.tokenizer = AutoTokenizer.from_pretrained(model_id)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(model_id, export=True)
+
+    def encode(self, texts: List[str], batch_size: int = 32) -> np.ndarray:
+        inputs = self.tokenizer(
+            texts, padding=True, truncation=True, max_length=384, return_tensors="np"
+        )
+        hidden = self.model(**inputs).last_hidden_state
+        mask = inputs["attention_mask"][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return pooled / np.linalg.norm(pooled, axis=1, keepdims=True)
+
+
+def load_model(model_name: str, variant: str):
+    if variant == "onnx":
+        return OnnxEncoder(model_name)
+
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name)
+    if variant == "int8":
+        import torch
+
+        model = torch.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    return model
+
+
+def _init_worker(model_name: str, variant: str):
+    global _model
+
+    import torch
+
+    # One intra-op thread per process, the pool provides the parallelism
+    torch.set_num_threads(1)
+    _model = load_model(model_name, variant)
+
+
+def _encode(texts: List[str]) -> List[List[float]]:
+    return np.asarray(_model.encode(texts, batch_size=len(texts))).tolist()
+
+
+class LocalEmbeddingEngine(Embeddings):
+    """Sentence-transformers embeddings sharded across a process pool.
+
+    Documents are sorted by length before batching so texts in a batch pad to
+    similar lengths, and batches are spread over LOCAL_EMBEDDING_WORKERS spawned
+    processes that each hold one model copy. Only calls made inside
+    ingesting() use the pool, which is shut down when the last of them ends,
+    so serving processes keep just their one in-process model between
+    reindexes. Queries and other calls are embedded in process.
+    """
+
+    def __init__(
+        self,
+        model_name: str = LOCAL_EMBEDDING_MODEL,
+        workers: int = LOCAL_EMBEDDING_WORKERS,
+        batch_size: int = LOCAL_EMBEDDING_BATCH_SIZE,
+        variant: str = LOCAL_EMBEDDING_VARIANT,
+    ):
+        self.model_name = model_name
+        self.workers = workers
+        self.batch_size = batch_size
+        self.variant = variant
+        self.pool = None
+        # Number of ingesting() contexts currently open
+        self.ingestions = 0
+        self.lock = threading.Lock()
+
+    @property
+    def model_id(self) -> str:
+        """Identifies the vectors this engine produces, e.g. for caching."""
+        if self.variant == "default":
+            return self.model_name
+        return f"{self.model_name}+{self.variant}"
+
+    def preload(self):
+        """Loads the in-process model now rather than on the first query."""
+        self._local_model()
+
+    def _local_model(self):
+        global _model
+
+        with self.lock:
+            if _model is None:
+                _model = load_model(self.model_name, self.variant)
+        return _model
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self.model_name, self.variant),
+                )
+                atexit.register(self.pool.shutdown, wait=False)
+        return self.pool
+
+    @contextmanager
+    def ingesting(self):
+        """Shards multi-batch embed_documents calls across the process pool
+        while open, e.g. for a reindex."""
+        with self.lock:
+            self.ingestions += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.ingestions -= 1
+                pool = self.pool if not self.ingestions else None
+                if pool is not None:
+                    self.pool = None
+                    atexit.unregister(pool.shutdown)
+            if pool is not None:
+                pool.shutdown()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        batches = [
+            [texts[i] for i in order[start : start + self.batch_size]]
+            for start in range(0, len(order), self.batch_size)
+        ]
+        if self.ingestions and self.workers > 1 and len(batches) > 1:
+            results = self._pool().map(_encode, batches)
+        else:
+            model = self._local_model()
+            results = (
+                np.asarray(model.encode(batch, batch_size=len(batch))).tolist()
+                for batch in batches
+            )
+
+        vectors = [None] * len(texts)
+        positions = iter(order)
+        for batch in results:
+            for vector in batch:
+                vectors[next(positions)] = vector
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return np.asarray(self._local_model().encode([text])[0]).tolist()
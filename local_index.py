@@ -0,0 +1,453 @@
+import json
+import os
+import threading
+import uuid
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.base import VectorStore
+
+from file_lock import file_lock, file_stamp, merge_changes
+from mmr import maximal_marginal_relevance, normalize_rows
+
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", os.path.join("data", "local_index"))
+
+# "brute" scores every vector, "ivf" only scans the clusters closest to the query
+LOCAL_INDEX_MODE = os.getenv("LOCAL_INDEX_MODE", "brute")
+LOCAL_INDEX_NPROBE = int(os.getenv("LOCAL_INDEX_NPROBE", 8))
+
+# persist() appends the changes since the last one as a segment, and rewrites
+# the whole index as a new base once this many segments have piled up.
+LOCAL_INDEX_MAX_SEGMENTS = int(os.getenv("LOCAL_INDEX_MAX_SEGMENTS", 32))
+
+# Below this many vectors a brute force scan is as fast as probing clusters
+IVF_MIN_SIZE = 4096
+# The IVF index is built when the store is persisted or refreshed, and
+# searches scan every vector until then.
+
+
+class IVFIndex:
+    """Inverted file index over unit vectors.
+
+    Vectors are bucketed under their nearest spherical k-means centroid and a
+    search only scores the vectors in the `nprobe` buckets closest to the query.
+    """
+
+    def __init__(self, vectors: np.ndarray, nlist: int = None, iterations: int = 10):
+        rng = np.random.default_rng(0)
+        nlist = nlist or max(1, int(np.sqrt(len(vectors))))
+        sample = vectors[
+            rng.choice(len(vectors), min(len(vectors), nlist * 64), replace=False)
+        ]
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            empty = np.bincount(assignments, minlength=nlist) == 0
+            sums[empty] = centroids[empty]
+            centroids = normalize_rows(sums)
+
+        assignments = np.concatenate(
+            [
+                np.argmax(vectors[start : start + 8192] @ centroids.T, axis=1)
+                for start in range(0, len(vectors), 8192)
+            ]
+        )
+        self.centroids = centroids
+        self.order = np.argsort(assignments, kind="stable").astype(np.int32)
+        self.offsets = np.searchsorted(assignments[self.order], np.arange(nlist + 1))
+
+    def candidates(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        probes = np.argsort(-(self.centroids @ query))[:nprobe]
+        return np.concatenate(
+            [self.order[self.offsets[c] : self.offsets[c + 1]] for c in probes]
+        )
+
+
+class LocalDocumentStore(VectorStore):
+    """In-process vector store over a float32 matrix of unit vectors.
+
+    Documents live in memory next to the matrix and are persisted to
+    LOCAL_INDEX_PATH as a base .npy file (memory-mapped on load) and JSON file,
+    plus segments holding the changes of each later persist().
+    """
+
+    def __init__(
+        self,
+        embedding: Embeddings,
+        path: str = LOCAL_INDEX_PATH,
+        mode: str = LOCAL_INDEX_MODE,
+        nprobe: int = LOCAL_INDEX_NPROBE,
+    ):
+        self.embedding = embedding
+        self.path = path
+        self.mode = mode
+        self.nprobe = nprobe
+        self.vectors = None
+        # Writable storage behind self.vectors, which is a view of its first rows
+        self.buffer = None
+        self.ids = []
+        self.texts = []
+        self.metadatas = []
+        self.positions = {}
+        self.ivf = None
+        self.lock = threading.RLock()
+        # Base generation and segments on disk this copy has applied, and the
+        # version of the manifest naming them
+        self.loaded = False
+        self.generation = None
+        self.segments = 0
+        self.stamp = None
+        # Ids added, updated or deleted here and not persisted yet
+        self.changed = set()
+
+    @classmethod
+    def load(cls, embedding: Embeddings, path: str = LOCAL_INDEX_PATH, **kwargs):
+        store = cls(embedding, path=path, **kwargs)
+        store.refresh()
+        if store.ids:
+            print(f"Loaded {len(store.ids)} vectors from {path}")
+        return store
+
+    def refresh(self):
+        """Applies what other gunicorn workers persisted since this copy last
+        read or wrote the index, usually just their new segments."""
+        with self.lock:
+            if self.loaded and file_stamp(self._manifest_path()) == self.stamp:
+                return
+            with file_lock(self._manifest_path(), exclusive=False):
+                self._reload()
+
+    @property
+    def identity(self) -> str:
+        """Names the index this store writes to, e.g. to key ingestion state."""
+        return f"local:{os.path.abspath(self.path)}"
+
+    def _manifest_path(self) -> str:
+        return os.path.join(self.path, "manifest.json")
+
+    def _segment_path(self, number: int) -> str:
+        return os.path.join(self.path, "segments", f"{number:06d}")
+
+    def _read_manifest(self) -> Optional[dict]:
+        if os.path.exists(self._manifest_path()):
+            with open(self._manifest_path()) as f:
+                return json.load(f)
+        # Written before segments existed
+        if os.path.exists(os.path.join(self.path, "documents.json")):
+            return {"generation": 0, "segments": 0}
+        return None
+
+    def _reload(self):
+        """Catches up with the index on disk and reapplies the changes made here
+        that aren't persisted yet. Expects the file lock held."""
+        stamp = file_stamp(self._manifest_path())
+        if self.loaded and stamp == self.stamp:
+            return
+        self.loaded = True
+        self.stamp = stamp
+        manifest = self._read_manifest()
+        if manifest is None:
+            return
+
+        merge_changes(
+            self, lambda: self._catch_up(manifest), self._snapshot, self._reapply
+        )
+        self._build_ivf()
+
+    def _catch_up(self, manifest: dict):
+        """Reads the base if it was rewritten and applies the newer segments."""
+        if manifest["generation"] != self.generation:
+            with open(os.path.join(self.path, "documents.json")) as f:
+                documents = json.load(f)
+            self.ids = documents["ids"]
+            self.texts = documents["texts"]
+            self.metadatas = documents["metadatas"]
+            self.positions = {_id: i for i, _id in enumerate(self.ids)}
+            self.vectors = np.load(os.path.join(self.path, "vectors.npy"), mmap_mode="r")
+            self.buffer = None
+            self.ivf = None
+            self.generation = manifest["generation"]
+            self.segments = 0
+        for number in range(self.segments + 1, manifest["segments"] + 1):
+            self._apply_segment(number)
+        self.segments = manifest["segments"]
+
+    def _snapshot(self, ids: List[str]):
+        return (
+            [self._document(self.positions[_id]) for _id in ids],
+            np.array([self.vectors[self.positions[_id]] for _id in ids]),
+        )
+
+    def _reapply(self, updated: List[str], rows, deleted: List[str]):
+        self.delete_ids(deleted)
+        if updated:
+            self.add_vectors(rows[0], rows[1], updated)
+
+    def _apply_segment(self, number: int):
+        path = self._segment_path(number)
+        with open(path + ".json") as f:
+            segment = json.load(f)
+        self.delete_ids(segment["deleted"])
+        if segment["ids"]:
+            documents = [
+                Document(page_content=text, metadata=metadata)
+                for text, metadata in zip(segment["texts"], segment["metadatas"])
+            ]
+            self.add_vectors(documents, np.load(path + ".npy"), segment["ids"])
+
+    def persist(self):
+        with self.lock:
+            with file_lock(self._manifest_path()):
+                self._reload()
+                if self.vectors is None:
+                    # Nothing on disk or added here, so the recorded deletes
+                    # have nothing to remove. Kept, they would be replayed
+                    # after a later reload over rows other workers wrote.
+                    self.changed = set()
+                    return
+                if not self.changed:
+                    return
+                replaced_segments = 0
+                if self.generation is None or self.segments >= LOCAL_INDEX_MAX_SEGMENTS:
+                    replaced_segments = self.segments
+                    self._write_base()
+                else:
+                    self._write_segment(self.segments + 1)
+                with open(self._manifest_path() + ".tmp", "w") as f:
+                    json.dump({"generation": self.generation, "segments": self.segments}, f)
+                os.replace(self._manifest_path() + ".tmp", self._manifest_path())
+                self.stamp = file_stamp(self._manifest_path())
+                self.changed = set()
+                # Only unreferenced once the manifest names the new base
+                for number in range(1, replaced_segments + 1):
+                    for extension in (".json", ".npy"):
+                        os.remove(self._segment_path(number) + extension)
+            self._build_ivf()
+
+    def _build_ivf(self):
+        """Clusters the vectors for "ivf" mode, outside of any query."""
+        if self.mode == "ivf" and self.ivf is None and len(self.ids) >= IVF_MIN_SIZE:
+            self.ivf = IVFIndex(np.asarray(self.vectors))
+
+    def _write_segment(self, number: int):
+        """Writes the rows changed since the last persist and the deleted ids."""
+        updated = [_id for _id in self.changed if _id in self.positions]
+        path = self._segment_path(number)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".npy", "wb") as f:
+            np.save(f, np.asarray(self.vectors)[[self.positions[_id] for _id in updated]])
+        with open(path + ".json", "w") as f:
+            json.dump(
+                {
+                    "ids": updated,
+                    "texts": [self.texts[self.positions[_id]] for _id in updated],
+                    "metadatas": [self.metadatas[self.positions[_id]] for _id in updated],
+                    "deleted": [_id for _id in self.changed if _id not in self.positions],
+                },
+                f,
+            )
+        self.segments = number
+
+    def _write_base(self):
+        """Rewrites the whole index as a new generation."""
+        os.makedirs(self.path, exist_ok=True)
+        vectors_path = os.path.join(self.path, "vectors.npy")
+        with open(vectors_path + ".tmp", "wb") as f:
+            np.save(f, np.asarray(self.vectors))
+        documents_path = os.path.join(self.path, "documents.json")
+        with open(documents_path + ".tmp", "w") as f:
+            json.dump(
+                {"ids": self.ids, "texts": self.texts, "metadatas": self.metadatas},
+                f,
+            )
+        os.replace(vectors_path + ".tmp", vectors_path)
+        os.replace(documents_path + ".tmp", documents_path)
+        self.generation = (self.generation or 0) + 1
+        self.segments = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add_vectors(
+        self,
+        documents: List[Document],
+        vectors: List[List[float]],
+        ids: Optional[List[Optional[str]]] = None,
+    ) -> List[str]:
+        vectors = normalize_rows(np.asarray(vectors, dtype=np.float32))
+        ids = [_id or str(uuid.uuid4()) for _id in ids or [None] * len(documents)]
+        with self.lock:
+            new_ids = [_id for _id in dict.fromkeys(ids) if _id not in self.positions]
+            self._reserve(len(new_ids), vectors.shape[1])
+
+            self.changed.update(ids)
+            for doc, vector, _id in zip(documents, vectors, ids):
+                position = self.positions.get(_id)
+                if position is None:
+                    position = self.positions[_id] = len(self.ids)
+                    self.ids.append(_id)
+                    self.texts.append(doc.page_content)
+                    self.metadatas.append(dict(doc.metadata))
+                else:
+                    self.texts[position] = doc.page_content
+                    self.metadatas[position] = dict(doc.metadata)
+                self.buffer[position] = vector
+            self.vectors = self.buffer[: len(self.ids)]
+            self.ivf = None
+        return ids
+
+    def _reserve(self, rows: int, dimensions: int):
+        """Grows the backing buffer geometrically so appends are amortized O(1)."""
+        size = len(self.ids)
+        if self.buffer is not None and len(self.buffer) >= size + rows:
+            return
+        capacity = max(size + rows, 2 * size, 1024)
+        buffer = np.zeros((capacity, dimensions), dtype=np.float32)
+        if size:
+            buffer[:size] = self.vectors
+        self.buffer = buffer
+
+    def delete_ids(self, ids: List[str]):
+        with self.lock:
+            drop = {self.positions[_id] for _id in ids if _id in self.positions}
+            self.changed.update(ids)
+            if not drop:
+                return
+            keep = [i for i in range(len(self.ids)) if i not in drop]
+            self.buffer = np.asarray(self.vectors)[keep]
+            self.vectors = self.buffer
+            self.ids = [self.ids[i] for i in keep]
+            self.texts = [self.texts[i] for i in keep]
+            self.metadatas = [self.metadatas[i] for i in keep]
+            self.positions = {_id: i for i, _id in enumerate(self.ids)}
+            self.ivf = None
+
+    def iter_documents(self):
+        self.refresh()
+        with self.lock:
+            documents = list(zip(self.ids, range(len(self.ids))))
+        for _id, position in documents:
+            yield _id, self._document(position)
+
+    def ids_where(self, key: str, values: List[str]) -> set:
+        values = set(values)
+        self.refresh()
+        with self.lock:
+            return {
+                _id
+                for _id, metadata in zip(self.ids, self.metadatas)
+                if metadata.get(key) in values
+            }
+
+    def vectors_by_id(self, ids: List[str]) -> Dict[str, np.ndarray]:
+        """Stored vectors of the given documents, keyed by id."""
+        self.refresh()
+        with self.lock:
+            return {
+                _id: np.array(self.vectors[self.positions[_id]])
+                for _id in ids
+                if _id in self.positions
+            }
+
+    def search(self, embedding: List[float], k: int):
+        """Returns the positions and cosine similarities of the top k vectors."""
+        query = normalize_rows(np.asarray(embedding, dtype=np.float32))
+        self.refresh()
+        with self.lock:
+            if not self.ids:
+                return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+            if self.ivf is not None:
+                candidates = self.ivf.candidates(query, self.nprobe)
+                scores = self.vectors[candidates] @ query
+            else:
+                candidates = np.arange(len(self.ids))
+                scores = self.vectors @ query
+
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return candidates[top], scores[top]
+
+    def search_with_vectors(self, embedding: List[float], k: int):
+        """Returns the k nearest documents and their vectors."""
+        # Held across the search so the positions still point at the same rows
+        with self.lock:
+            positions, _ = self.search(embedding, k)
+            return (
+                [self._document(position) for position in positions],
+                np.array(self.vectors[positions]),
+            )
+
+    def _document(self, position: int) -> Document:
+        return Document(
+            page_content=self.texts[position], metadata=dict(self.metadatas[position])
+        )
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        documents = [
+            Document(page_content=text, metadata=metadata)
+            for text, metadata in zip(texts, metadatas)
+        ]
+        vectors = self.embedding.embed_documents(texts)
+        return self.add_vectors(documents, vectors, kwargs.get("uuids"))
+
+    def similarity_search(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Document]:
+        return self.similarity_search_by_vector(self.embedding.embed_query(query), k)
+
+    def similarity_search_by_vector(
+        self, embedding: List[float], k: int = 4, **kwargs: Any
+    ) -> List[Document]:
+        with self.lock:
+            positions, _ = self.search(embedding, k)
+            return [self._document(position) for position in positions]
+
+    def max_marginal_relevance_search(
+        self,
+        query: str,
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        **kwargs: Any,
+    ) -> List[Document]:
+        return self.max_marginal_relevance_search_by_vector(
+            self.embedding.embed_query(query), k, fetch_k, lambda_mult
+        )
+
+    def max_marginal_relevance_search_by_vector(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        **kwargs: Any,
+    ) -> List[Document]:
+        docs, vectors = self.search_with_vectors(embedding, fetch_k)
+        selected = maximal_marginal_relevance(
+            embedding, vectors, k=k, lambda_mult=lambda_mult
+        )
+        return [docs[i] for i in selected]
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        **kwargs: Any,
+    ) -> "LocalDocumentStore":
+        store = cls(embedding, **kwargs)
+        store.add_texts(texts, metadatas)
+        return store
@@ -1,3 +1,9 @@
+import import_timing
+
+import_timing.install_from_env()
+
+import asyncio
+import json
 import logging
 import os
 from typing import List, Optional
@@ -6,12 +12,14 @@ from typing import List, Optional
 import sentry_sdk
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
-from ai import ai_chat_thread
-from pipeline import MaxPipeline, Entries
-from slack import app as slack_app
+from ai import ai_chat_thread, ai_chat_thread_stream, semantic_cache
+from llm import chat_client
+from pipeline import MMR_FETCH_K, MMR_K, MMR_LAMBDA, Entries, get_pipeline
+from prompt_registry import registry as prompt_registry
 
 load_dotenv()  # take environment variables from .env.
 
@@ -53,33 +61,52 @@ class Query(BaseModel):
     query: str
 
 
-class GitHubRepo(BaseModel):
-    repo: Optional[str]
+class ContextQuery(Query):
+    k: int = MMR_K
+    fetch_k: int = MMR_FETCH_K
+    lambda_mult: float = MMR_LAMBDA
 
 
-pipeline = MaxPipeline(openai_token=os.getenv("OPENAI_TOKEN"))
+class GitHubRepo(BaseModel):
+    repo: Optional[str]
+    full: bool = False
 
 
 @app.post("/entries")
-def create_entries(entries: Entries):
-    pipeline.embed_markdown_document(entries)
+def create_entries(entries: Entries, bulk: bool = True):
+    get_pipeline().embed_markdown_document(entries, bulk=bulk)
     return []
 
 
 @app.post("/_git")
 def create_git_entries(gh_repo: GitHubRepo):
-    pipeline.embed_git_repo(gh_repo=gh_repo.repo)
+    get_pipeline().embed_git_repo(gh_repo=gh_repo.repo, full=gh_repo.full)
     return {"status": "ok"}
 
 
 @app.post("/_chat")
 def test_chat(query: Query):
-    return pipeline.chat(query.query)
+    return get_pipeline().chat(query.query)
 
 
 @app.post("/_context")
-def test_context(query: Query):
-    return pipeline.retrieve_context(query.query)
+async def test_context(query: ContextQuery):
+    return await get_pipeline().aretrieve_context(
+        query.query, k=query.k, fetch_k=query.fetch_k, lambda_mult=query.lambda_mult
+    )
+
+
+@app.get("/_stats")
+def stats():
+    from insight_generator import insight_stats
+    from slack_jobs import jobs as slack_jobs
+
+    return {
+        "query_embedding_cache": get_pipeline().embeddings.query_cache.stats(),
+        "semantic_cache": semantic_cache.stats() if semantic_cache else None,
+        "insights": insight_stats(),
+        "slack_jobs": slack_jobs.stats(),
+    }
 
 
 @app.post("/spawn")
@@ -94,34 +121,110 @@ def update_oncall():
 
 
 @app.post("/chat")
-async def chat(messages: List[Message]):
+async def chat(messages: List[Message], stream: bool = False):
     msgs = [msg.dict() for msg in messages]
+    if stream:
+        return StreamingResponse(
+            stream_events(ai_chat_thread_stream(msgs)), media_type="text/event-stream"
+        )
     response = await ai_chat_thread(msgs)
     return response
 
 
+async def stream_events(chunks):
+    """Server-Sent Events with one {"content": ...} message per chunk of the
+    response, terminated by a [DONE] message."""
+    async for chunk in chunks:
+        yield f"data: {json.dumps({'content': chunk})}\n\n"
+    yield "data: [DONE]\n\n"
+
+
 @app.get("/_health")
 def health():
     return {"status": "ok"}
 
 
+@app.get("/_imports")
+def imports():
+    return {"enabled": import_timing.MAX_IMPORT_TIMING, "report": import_timing.report()}
+
+
 # Slack Bolt App
-from slack_bolt.adapter.fastapi.async_handler import AsyncSlackRequestHandler
+# slack_bolt and the listeners in slack.py are imported on first use, or by the
+# warm up below, so they don't delay the server from starting.
+_slack_handler = None
+
+
+def get_slack_handler():
+    global _slack_handler
+    if _slack_handler is None:
+        from slack_bolt.adapter.fastapi.async_handler import AsyncSlackRequestHandler
+
+        from slack import app as slack_app
 
-app_handler = AsyncSlackRequestHandler(slack_app)
+        _slack_handler = AsyncSlackRequestHandler(slack_app)
+    return _slack_handler
+
+
+def warm_up():
+    get_slack_handler()
+    get_pipeline()
+    prompt_registry.warm()
+    warm_up_knowledge()
+    warm_up_classifier()
+    if import_timing.MAX_IMPORT_TIMING:
+        print(f"Imports after warm up:\n{import_timing.report()}")
+
+
+def warm_up_knowledge():
+    import inference
+    from knowledge_index import get_knowledge_index
+
+    if inference.KNOWLEDGE_RETRIEVAL:
+        get_knowledge_index(
+            "feature flags", inference.feature_flag_docs + inference.extended_prompt
+        )
+
+
+def warm_up_classifier():
+    from slack import QUESTION_ROUTING
+
+    if QUESTION_ROUTING:
+        from classification import get_classifier
+
+        get_classifier()
+
+
+@app.on_event("startup")
+async def schedule_warm_up():
+    if os.getenv("WARM_UP_ON_STARTUP", "true").lower() == "true":
+        asyncio.get_running_loop().run_in_executor(None, warm_up)
+    if os.getenv("PD_API_KEY"):
+        from plugins.pagerduty import oncall_cache
+
+        oncall_cache.start()
+
+
+@app.on_event("shutdown")
+async def close_chat_client():
+    await chat_client.close()
 
 
 @app.post("/slack/events")
 async def slack_events(req: Request):
-    return await app_handler.handle(req)
+    return await get_slack_handler().handle(req)
 
 
 @app.get("/slack/oauth_redirect")
 async def oauth_redirect(req: Request):
     logging.info("Installation completed.")
-    return await app_handler.handle(req)
+    return await get_slack_handler().handle(req)
 
 
 @app.get("/slack/install")
 async def install(req: Request):
-    return await app_handler.handle(req)
+    return await get_slack_handler().handle(req)
+
+
+if import_timing.MAX_IMPORT_TIMING:
+    print(f"Imports while loading main:\n{import_timing.report()}")
@@ -0,0 +1,45 @@
+from typing import List, Optional
+
+import numpy as np
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Scales each row of a matrix, or a single vector, to unit length. Zero
+    rows are left as they are."""
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+def maximal_marginal_relevance(
+    query: np.ndarray,
+    candidates: np.ndarray,
+    k: int = 4,
+    lambda_mult: float = 0.5,
+    relevance: Optional[np.ndarray] = None,
+) -> List[int]:
+    """Greedy MMR selection over a candidate matrix.
+
+    All pairwise candidate similarities come from a single matrix product, and
+    each of the k selection steps is one vectorized update of the running
+    "most similar selected candidate" array, so there is no per-candidate Python
+    loop. `relevance` overrides the cosine similarity to the query, e.g. with
+    fused hybrid scores.
+    """
+    candidates = np.asarray(candidates, dtype=np.float32)
+    if not len(candidates) or k <= 0:
+        return []
+    candidates = normalize_rows(candidates)
+
+    if relevance is None:
+        relevance = candidates @ normalize_rows(np.asarray(query, dtype=np.float32))
+    similarity = candidates @ candidates.T
+
+    selected = [int(np.argmax(relevance))]
+    max_similarity = similarity[selected[0]].copy()
+    for _ in range(min(k, len(candidates)) - 1):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        np.maximum(max_similarity, similarity[best], out=max_similarity)
+    return selected
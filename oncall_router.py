@@ -0,0 +1,75 @@
+import os
+import re
+from typing import Optional
+
+# Questions about who is on call or the current support hero are answered
+# from the cached PagerDuty snapshot instead of the LLM. Needs PD_API_KEY.
+ONCALL_ROUTING = (
+    os.getenv("ONCALL_ROUTING", "true").lower() == "true" and bool(os.getenv("PD_API_KEY"))
+)
+
+ONCALL_TERMS = r"\b(on[- ]?call|support hero(?:es)?|on duty)\b"
+# "who is", "who's", "who are", a few words at most, then the term
+WHO_IS = r"\bwho(?:['’]?s|\s+is|\s+are)"
+# Someone asked about, a few words at most before the term
+ASKING = r"\b(who|whom|anyone|anybody)\b(\s+[\w'’,-]+){0,4}?"
+# Matches "who's on call?", "who is the current support hero?" and "is
+# anyone on call right now?", but not "who uses the on-call rotation feature
+# in pagerduty?", "who should I talk to about deploying to Heroku?", "who can
+# see my heatmaps on the heroes page?", "what does the current on-call
+# process look like?" or "how do I add people to on call today in pagerduty"
+ONCALL_QUESTION_RES = [
+    re.compile(rf"{WHO_IS}(\s+[\w'’-]+){{0,3}}?\s+{ONCALL_TERMS}", re.IGNORECASE),
+    re.compile(rf"{ASKING}\s+(current|today'?s|this week'?s)\s+{ONCALL_TERMS}", re.IGNORECASE),
+    re.compile(rf"{ASKING}\s+{ONCALL_TERMS}\s+(right now|today|this week)\b", re.IGNORECASE),
+]
+MENTION_RE = re.compile(r"<@[^>]+>")
+WORD_RE = re.compile(r"[a-z0-9]+")
+
+# Words that say nothing about which schedule is meant
+GENERIC_WORDS = {
+    "a", "about", "and", "are", "call", "can", "current", "currently", "duty",
+    "for", "hero", "i", "is", "it", "now", "of", "on", "oncall", "right",
+    "should", "talk", "that", "the", "this", "to", "today", "week", "who",
+    "whos", "s",
+}
+
+
+def is_oncall_question(text: str) -> bool:
+    text = MENTION_RE.sub("", text)
+    return any(pattern.search(text) for pattern in ONCALL_QUESTION_RES)
+
+
+def matching_schedules(text: str, oncalls: dict) -> dict:
+    """The schedules whose names share a specific word with the question, e.g.
+    "support" for the support hero, or all of them if none does."""
+    words = set(WORD_RE.findall(text.lower())) - GENERIC_WORDS
+    matches = {
+        name: users
+        for name, users in oncalls.items()
+        if words & set(WORD_RE.findall(name.lower()))
+    }
+    return matches or oncalls
+
+
+def format_oncalls(oncalls: dict) -> str:
+    lines = [
+        f"• *{name}*: {', '.join(users)}" for name, users in sorted(oncalls.items())
+    ]
+    return "*Currently on call:*\n" + "\n".join(lines)
+
+
+def answer_oncall_question(text: str) -> Optional[str]:
+    """A Slack-formatted answer if text asks who is on call, else None."""
+    if not ONCALL_ROUTING or not is_oncall_question(text):
+        return None
+
+    from plugins.pagerduty import oncall_cache
+
+    oncalls = oncall_cache.get()
+    if not oncalls:
+        return (
+            "I couldn't get the on-call schedules from PagerDuty just now. "
+            "Please try again in a minute :sleeping-hog:"
+        )
+    return format_oncalls(matching_schedules(MENTION_RE.sub("", text), oncalls))
@@ -1,28 +1,211 @@
+import asyncio
+import hashlib
+import json
 import os
+import queue
 import re
-from typing import List
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import lru_cache, partial
+from itertools import repeat
+from typing import TYPE_CHECKING, Iterable, Iterator, List, Optional, Tuple
 from pprint import pprint
 
-import weaviate
 from dotenv import load_dotenv
-from git import Repo
-from langchain.docstore.document import Document
-from langchain.document_loaders import GitLoader
-from langchain.text_splitter import MarkdownTextSplitter
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.embeddings import HuggingFaceEmbeddings
-from langchain.chains import RetrievalQAWithSourcesChain
-from langchain import OpenAI
-from langchain.vectorstores import Weaviate
 from pydantic import BaseModel
 
+# langchain, GitPython, weaviate, tiktoken and torch are slow to import and only
+# needed once the pipeline is built or a code path uses them, so they are
+# imported where they are used instead of here.
+if TYPE_CHECKING:
+    from langchain.docstore.document import Document
+
 
 load_dotenv()
 
 EXAMPLE_DATA_DIR = os.path.join(os.path.dirname(__file__), "example_data")
 
+# Last indexed commit and chunk count per file for each git repo and document
+# store, so that embed_git_repo only re-embeds what changed since the previous
+# run into the same store.
+INDEX_STATE_PATH = os.getenv(
+    "INDEX_STATE_PATH", os.path.join("data", "index_state.json")
+)
+GIT_FILE_EXTENSIONS = (".md", ".mdx")
+
+# Bulk ingestion limits. Chunks are embedded in batches bounded by both count and
+# token total, and each batch is written to the document store in one call.
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 256))
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", 60000))
+
+# "vector" ranks candidates by vector similarity, "hybrid" fuses that ranking with
+# BM25 over a local inverted index of the same chunks. Either way the final k
+# documents are picked from fetch_k candidates with maximal marginal relevance.
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "vector")
+MMR_K = int(os.getenv("MMR_K", 4))
+MMR_FETCH_K = int(os.getenv("MMR_FETCH_K", 20))
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", 0.5))
+
+# Maximum number of items buffered between two ingestion stages
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", 8))
+
+# Threads available per process to the blocking parts of async retrieval (vector
+# store queries, BM25, MMR), so one slow query doesn't hold up the event loop.
+RETRIEVAL_WORKERS = int(os.getenv("RETRIEVAL_WORKERS", 8))
+
+Chunk = Tuple["Document", Optional[str]]
+
+
+@lru_cache(maxsize=None)
+def get_encoding():
+    import tiktoken
+
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def batch_chunks(
+    chunks: Iterable[Chunk],
+    max_size: int = EMBED_BATCH_SIZE,
+    max_tokens: int = EMBED_BATCH_TOKENS,
+) -> Iterator[List[Chunk]]:
+    """Groups (document, id) pairs into batches bounded by count and total token
+    length."""
+    batch = []
+    batch_tokens = 0
+    for chunk in chunks:
+        tokens = len(get_encoding().encode(chunk[0].page_content, disallowed_special=()))
+        if batch and (len(batch) >= max_size or batch_tokens + tokens > max_tokens):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(chunk)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+class _StageError:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+_STAGE_DONE = object()
+
+
+def threaded_stage(source: Iterable, maxsize: int = INGEST_QUEUE_SIZE) -> Iterator:
+    """Consumes `source` in a background thread and yields its items through a
+    queue holding at most `maxsize` of them, so the producer runs ahead of the
+    consumer without buffering the whole stream. Errors are re-raised in the
+    consumer, and the producer stops if the consumer goes away."""
+    items = queue.Queue(maxsize)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run():
+        try:
+            for item in source:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(_StageError(e))
+        put(_STAGE_DONE)
+
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        while True:
+            item = items.get()
+            if item is _STAGE_DONE:
+                return
+            if isinstance(item, _StageError):
+                raise item.error
+            yield item
+    finally:
+        stopped.set()
+
+
+_retrieval_executor = None
+_retrieval_executor_pid = None
+_retrieval_executor_lock = threading.Lock()
+
+
+def get_retrieval_executor() -> ThreadPoolExecutor:
+    global _retrieval_executor, _retrieval_executor_pid
+    with _retrieval_executor_lock:
+        # A pool inherited through fork has no threads behind it
+        if _retrieval_executor is None or _retrieval_executor_pid != os.getpid():
+            _retrieval_executor = ThreadPoolExecutor(
+                max_workers=RETRIEVAL_WORKERS, thread_name_prefix="retrieval"
+            )
+            _retrieval_executor_pid = os.getpid()
+    return _retrieval_executor
+
+
+async def run_in_thread(func, *args, **kwargs):
+    """Runs a blocking call on the bounded retrieval pool and awaits its result."""
+    return await asyncio.get_running_loop().run_in_executor(
+        get_retrieval_executor(), partial(func, *args, **kwargs)
+    )
+
+
+_reindex_hooks = []
+
+
+def on_reindex(callback):
+    """Registers a callback to run whenever documents are added to or removed
+    from the index, e.g. to drop answers cached against the old docs."""
+    _reindex_hooks.append(callback)
+
+
+def notify_reindex():
+    for callback in _reindex_hooks:
+        callback()
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def document_id(doc: "Document") -> str:
+    return content_hash(doc.page_content + str(doc.metadata.get("source", "")))
+
+
+def chunk_uuid(identifier: str) -> str:
+    """Same value as weaviate.util.generate_uuid5(identifier), without importing
+    the weaviate client."""
+    return str(uuid.uuid5(uuid.NAMESPACE_DNS, identifier))
+
+
+def load_index_state() -> dict:
+    if not os.path.exists(INDEX_STATE_PATH):
+        return {}
+    with open(INDEX_STATE_PATH) as f:
+        return json.load(f)
+
+
+def save_index_state(state: dict):
+    os.makedirs(os.path.dirname(INDEX_STATE_PATH), exist_ok=True)
+    tmp_path = INDEX_STATE_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, INDEX_STATE_PATH)
+
+
+def git_chunk_ids(gh_repo: str, file_path: str, count: int) -> List[str]:
+    return [chunk_uuid(f"{gh_repo}/{file_path}#{i}") for i in range(count)]
+
 
 class Entry(BaseModel):
+    id: Optional[str] = None
     content: str
     meta: dict
 
@@ -31,53 +214,311 @@ class Entries(BaseModel):
     entries: List[Entry]
 
 
+def build_embeddings():
+    """Returns the embedding provider for EMBEDDING_METHOD and its model id."""
+    embed_setting = os.getenv("EMBEDDING_METHOD", "openai")
+    if embed_setting == "openai":
+        from langchain.embeddings.openai import OpenAIEmbeddings
+
+        print("Using OpenAI embeddings")
+        embeddings = OpenAIEmbeddings()
+        return embeddings, embeddings.model
+    elif embed_setting == "huggingface":
+        from local_embeddings import LocalEmbeddingEngine
+
+        print("Using HuggingFace embeddings")
+        embeddings = LocalEmbeddingEngine()
+        return embeddings, embeddings.model_id
+
+
+_pipeline = None
+_pipeline_pid = None
+_pipeline_lock = threading.Lock()
+_preloaded_embeddings = None
+
+
+def preload_embeddings():
+    """Builds the embedding provider and loads its model weights in this process.
+
+    Meant to run in the gunicorn master before workers fork: every worker's
+    pipeline then reuses the same provider, whose weights are shared
+    copy-on-write instead of loaded once per worker.
+    """
+    global _preloaded_embeddings
+    _preloaded_embeddings = build_embeddings()
+    embeddings, _ = _preloaded_embeddings
+    if hasattr(embeddings, "preload"):
+        embeddings.preload()
+
+
+def get_pipeline() -> "MaxPipeline":
+    """Returns the process-wide MaxPipeline, creating it on first use.
+
+    A pipeline inherited through fork is never reused, as its store client and
+    cache connections belong to the parent process.
+    """
+    global _pipeline, _pipeline_pid
+    with _pipeline_lock:
+        if _pipeline is None or _pipeline_pid != os.getpid():
+            _pipeline = MaxPipeline(openai_token=os.getenv("OPENAI_TOKEN"))
+            _pipeline_pid = os.getpid()
+    return _pipeline
+
+
+_embedding_indexes = {}
+_embedding_index_locks = {}
+
+
+def get_embedding_index(name: str, build):
+    """Returns the process-wide index `name`, built by build(embeddings) on
+    first use and again whenever the pipeline, and so its embeddings, is
+    rebuilt, e.g. in a forked worker. The index keeps the embeddings it was
+    built with as `index.embeddings`."""
+    embeddings = get_pipeline().embeddings
+    with _pipeline_lock:
+        lock = _embedding_index_locks.setdefault(name, threading.Lock())
+    with lock:
+        index = _embedding_indexes.get(name)
+        if index is None or index.embeddings is not embeddings:
+            index = _embedding_indexes[name] = build(embeddings)
+    return index
+
+
 class MaxPipeline:
     def __init__(self, openai_token: str):
+        from langchain.text_splitter import MarkdownTextSplitter
+
+        from document_store import build_document_store
+        from embedding_cache import CachedEmbeddings, EmbeddingCache
+
         self.openai_token = openai_token
-        embed_setting = os.getenv("EMBEDDING_METHOD", "openai")
-        if embed_setting == "openai":
-            print("Using OpenAI embeddings")
-            self.embeddings = OpenAIEmbeddings()
-        elif embed_setting == "huggingface":
-            print("Using HuggingFace embeddings")
-            self.embeddings = HuggingFaceEmbeddings(model_name="all-mpnet-base-v2")
+        embeddings, model = _preloaded_embeddings or build_embeddings()
+        self.embeddings = CachedEmbeddings(embeddings, model, EmbeddingCache())
         self.splitter = MarkdownTextSplitter(chunk_size=1000, chunk_overlap=0)
 
-        weaviate_auth_config = weaviate.AuthApiKey(
-            api_key=os.getenv("WEAVIATE_API_KEY")
+        self.document_store = build_document_store(self.embeddings)
+
+        self.retriever = self.document_store.as_retriever(search_type="mmr")
+
+        self.lexical_index = None
+        if RETRIEVAL_MODE == "hybrid":
+            from lexical_index import BM25Index
+
+            self.lexical_index = BM25Index.load()
+            if not len(self.lexical_index):
+                self.rebuild_lexical_index()
+
+    def rebuild_lexical_index(self):
+        print("Building lexical index from the document store")
+        self.lexical_index = type(self.lexical_index)(self.lexical_index.path)
+        ids, documents = [], []
+        for _id, doc in self.document_store.iter_documents():
+            ids.append(_id)
+            documents.append(doc)
+        self.lexical_index.add(documents, ids)
+        self.lexical_index.persist()
+
+    def embed_markdown_document(self, documents: Entries, bulk: bool = True):
+        """Splits and embeds entries. Entries with an id are upserted: their chunks
+        get ids derived from the entry id and content hash, unchanged chunks are
+        skipped and chunks no longer produced by the entry are deleted."""
+        from langchain.docstore.document import Document
+
+        existing = self._existing_entry_chunks(
+            [entry.id for entry in documents.entries if entry.id]
+        )
+        kept = set()
+        per_entry = []
+        for entry in documents.entries:
+            docs, ids = [], []
+            for text in self.splitter.split_text(entry.content):
+                if not text:
+                    continue
+                metadata = dict(entry.meta)
+                chunk_id = None
+                if entry.id:
+                    digest = content_hash(
+                        text + json.dumps(entry.meta, sort_keys=True, default=str)
+                    )
+                    chunk_id = chunk_uuid(f"{entry.id}/{digest}")
+                    if chunk_id in kept:
+                        continue
+                    kept.add(chunk_id)
+                    if chunk_id in existing:
+                        continue
+                    metadata.update(entry_id=entry.id, content_hash=digest)
+                docs.append(Document(page_content=text, metadata=metadata))
+                ids.append(chunk_id)
+            per_entry.append((docs, ids))
+
+        stale_ids = [chunk_id for chunk_id in existing if chunk_id not in kept]
+        print(
+            f"Upserting {sum(len(docs) for docs, _ in per_entry)} chunks, "
+            f"{len(kept & existing)} unchanged, {len(stale_ids)} stale"
+        )
+
+        # New chunk ids come from their content, so they never collide with the
+        # stale ones. Those are only deleted once the new chunks are written, so
+        # a failed embedding call leaves the entry's previous version in place.
+        if bulk:
+            self.embed_documents_bulk(
+                [doc for docs, _ in per_entry for doc in docs],
+                ids=[_id for _, ids in per_entry for _id in ids],
+            )
+        else:
+            # One pool for all entries rather than one per entry
+            with self._ingesting():
+                for docs, ids in per_entry:
+                    self.embed_documents_bulk(docs, ids=ids)
+        if stale_ids:
+            self.delete_documents(stale_ids)
+        self._index_updated()
+
+    def _existing_entry_chunks(self, entry_ids: List[str]) -> set:
+        """Ids of the chunks currently stored for the given entries."""
+        if not entry_ids:
+            return set()
+        return self.document_store.ids_where("entry_id", entry_ids)
+
+    def embed_documents(self, documents: List["Document"]):
+        ids = self.document_store.add_documents(documents)
+        if self.lexical_index is not None:
+            self.lexical_index.add(documents, ids)
+        self._index_updated()
+
+    def embed_documents_bulk(
+        self, documents: Iterable["Document"], ids: Optional[List[str]] = None
+    ):
+        """Embeds documents in size and token bounded batches and writes each
+        batch to the document store in one call instead of one per document."""
+        return self._write_chunks(zip(documents, ids if ids is not None else repeat(None)))
+
+    def _ingesting(self):
+        """Lets a local embedding engine use its process pool for the duration."""
+        ingesting = getattr(self.embeddings.embeddings, "ingesting", None)
+        return ingesting() if ingesting is not None else nullcontext()
+
+    def _write_chunks(self, chunks: Iterable[Chunk]) -> int:
+        """Embeds batches in a background stage while the previous batch is being
+        written, so embedding and store round-trips overlap."""
+
+        def embedded():
+            for batch in batch_chunks(chunks):
+                docs = [doc for doc, _ in batch]
+                vectors = self.embeddings.embed_documents(
+                    [doc.page_content for doc in docs]
+                )
+                yield docs, vectors, [_id for _, _id in batch]
+
+        total = 0
+        with self._ingesting():
+            for docs, vectors, ids in threaded_stage(embedded()):
+                written_ids = self.document_store.add_vectors(docs, vectors, ids)
+                if self.lexical_index is not None:
+                    self.lexical_index.add(docs, written_ids)
+                total += len(docs)
+                print(f"Embedded {total} chunks")
+        return total
+
+    def _index_updated(self):
+        self.document_store.persist()
+        if self.lexical_index is not None:
+            self.lexical_index.persist()
+        notify_reindex()
+
+    def retrieve_context(
+        self,
+        query: str,
+        k: int = MMR_K,
+        fetch_k: int = MMR_FETCH_K,
+        lambda_mult: float = MMR_LAMBDA,
+    ):
+        """Fetches fetch_k candidates with their vectors and picks k of them
+        with maximal marginal relevance."""
+        query_vector = self.embeddings.embed_query(query)
+        docs, vectors = self.document_store.search_with_vectors(query_vector, fetch_k)
+        return self._rerank(query, query_vector, docs, vectors, k, fetch_k, lambda_mult)
+
+    async def aretrieve_context(
+        self,
+        query: str,
+        k: int = MMR_K,
+        fetch_k: int = MMR_FETCH_K,
+        lambda_mult: float = MMR_LAMBDA,
+        query_vector: Optional[List[float]] = None,
+    ):
+        """retrieve_context for async callers. The query is embedded without
+        blocking, unless the caller already did, and the store query and
+        re-ranking run on the retrieval pool."""
+        if query_vector is None:
+            query_vector = await self.embeddings.aembed_query(query)
+        docs, vectors = await self.asearch_with_vectors(query_vector, fetch_k)
+        return await run_in_thread(
+            self._rerank, query, query_vector, docs, vectors, k, fetch_k, lambda_mult
         )
 
-        weaviate_client = weaviate.Client(
-            url=os.getenv("WEAVIATE_URL"), auth_client_secret=weaviate_auth_config
+    async def asearch_with_vectors(self, query_vector: List[float], k: int):
+        return await run_in_thread(
+            self.document_store.search_with_vectors, query_vector, k
         )
 
-        self.document_store = Weaviate(
-            client=weaviate_client,
-            index_name="Posthog_docs",
-            by_text=False,
-            text_key="page_content",
-            embedding=self.embeddings,
-            attributes=["source"],
+    def _rerank(self, query: str, query_vector, docs, vectors, k, fetch_k, lambda_mult):
+        from mmr import maximal_marginal_relevance
+
+        relevance = None
+        if self.lexical_index is not None:
+            docs, vectors, relevance = self._fuse_lexical(query, docs, vectors, fetch_k)
+        selected = maximal_marginal_relevance(
+            query_vector, vectors, k=k, lambda_mult=lambda_mult, relevance=relevance
         )
+        return [docs[i] for i in selected]
 
-        self.retriever = self.document_store.as_retriever(search_type="mmr")
+    def _fuse_lexical(self, query: str, docs, vectors, fetch_k: int):
+        """Fuses the vector and BM25 rankings with reciprocal-rank fusion.
 
-    def embed_markdown_document(self, documents: Entries):
-        for entry in documents.entries:
-            texts = self.splitter.split_text(entry.content)
+        Vectors for candidates only found by BM25 are fetched from the document
+        store by id, and the normalized fused scores are used as MMR relevance.
+        """
+        import numpy as np
 
-            documents = [
-                Document(page_content=doc, metadata=entry.meta) for doc in texts if doc
-            ]
-            self.embed_documents(documents)
+        from lexical_index import reciprocal_rank_fusion
+
+        candidates = {document_id(doc): [doc, vector] for doc, vector in zip(docs, vectors)}
+        vector_ranking = list(candidates)
+        lexical_ranking = []
+        store_ids = {}
+        for doc, _id, _ in self.lexical_index.search(query, fetch_k):
+            key = document_id(doc)
+            lexical_ranking.append(key)
+            store_ids[key] = _id
+            candidates.setdefault(key, [doc, None])
 
-    def embed_documents(self, documents: List[Document]):
-        self.document_store.add_documents(documents)
+        fused = reciprocal_rank_fusion([vector_ranking, lexical_ranking])[:fetch_k]
+        missing = [key for key, _ in fused if candidates[key][1] is None]
+        if missing:
+            stored = self.document_store.vectors_by_id([store_ids[key] for key in missing])
+            for key in missing:
+                candidates[key][1] = stored.get(store_ids[key])
+            # Only a lexical index out of step with the store has ids it lacks
+            unknown = [key for key in missing if candidates[key][1] is None]
+            if unknown:
+                embedded = self.embeddings.embed_documents(
+                    [candidates[key][0].page_content for key in unknown]
+                )
+                for key, vector in zip(unknown, embedded):
+                    candidates[key][1] = vector
 
-    def retrieve_context(self, query: str):
-        return self.retriever.get_relevant_documents(query)
+        relevance = np.array([score for _, score in fused], dtype=np.float32)
+        return (
+            [candidates[key][0] for key, _ in fused],
+            np.array([candidates[key][1] for key, _ in fused], dtype=np.float32),
+            relevance / relevance.max() if len(relevance) else relevance,
+        )
 
     def chat(self, query: str):
+        from langchain import OpenAI
+        from langchain.chains import RetrievalQAWithSourcesChain
+
         chain = RetrievalQAWithSourcesChain.from_chain_type(
             OpenAI(temperature=0), chain_type="stuff", retriever=self.retriever
         )
@@ -87,7 +528,16 @@ class MaxPipeline:
         )
         return results
 
-    def embed_git_repo(self, gh_repo):
+    def delete_documents(self, ids: List[str]):
+        self.document_store.delete_ids(ids)
+        if self.lexical_index is not None:
+            self.lexical_index.delete(ids)
+
+    def embed_git_repo(self, gh_repo, full: bool = False):
+        from git import Repo
+        from git.exc import BadName
+        from langchain.docstore.document import Document
+
         repo_url = f"https://github.com/{gh_repo}.git"
         repo_dir = gh_repo.split("/")[-1]
         path = os.path.join(EXAMPLE_DATA_DIR, repo_dir)
@@ -102,23 +552,117 @@ class MaxPipeline:
             repo = Repo(path)
             repo.git.pull()
 
-        branch = repo.head.reference
-        loader = GitLoader(
-            repo_path=path,
-            branch=branch,
-            file_filter=lambda file_path: file_path.endswith((".md", ".mdx")),
-        )
-        data = loader.load()
-        for page in data:
-            docs = []
-            text = self.splitter.split_text(page.page_content)
-            metadata = page.metadata
-            print(f"Adding {page.metadata['source']}")
-            page.metadata[
-                "source"
-            ] = f"https://github.com/{gh_repo}/blob/master/{page.metadata['source']} "
-            for token in text:
-                docs.append(Document(page_content=token, metadata=metadata))
-            self.document_store.add_documents(docs)
+        state = load_index_state()
+        store_state = state.setdefault(self.document_store.identity, {})
+        repo_state = store_state.get(gh_repo, {"commit": None, "files": {}})
+        if hasattr(self.document_store, "__len__") and not len(self.document_store):
+            # Wiped since the last run
+            repo_state = {"commit": None, "files": {}}
+        head = repo.head.commit.hexsha
+
+        if repo_state["commit"] == head and not full:
+            print(f"{gh_repo} already indexed at {head}")
+            return
+
+        changed, removed = None, []
+        if repo_state["commit"] and not full:
+            try:
+                changed, removed = self._git_changes(repo, repo_state["commit"], head)
+                print(
+                    f"Indexing {repo_state['commit'][:7]}..{head[:7]}: "
+                    f"{len(changed)} changed, {len(removed)} removed"
+                )
+            except (BadName, ValueError):
+                print(f"Last indexed commit {repo_state['commit']} not found")
+
+        if changed is None:
+            print(f"Indexing all of {gh_repo} at {head}")
+            changed = [
+                file_path
+                for file_path in repo.git.ls_files().splitlines()
+                if file_path.endswith(GIT_FILE_EXTENSIONS)
+            ]
+            removed = list(set(repo_state["files"]) - set(changed))
+
+        files = repo_state["files"]
+        stale_ids = []
+        for file_path in [*removed, *changed]:
+            stale_ids += git_chunk_ids(gh_repo, file_path, files.pop(file_path, 0))
+        if full or not repo_state["commit"]:
+            stale_ids += self._repo_chunk_ids(gh_repo)
+        written = set()
+
+        # Reading files, splitting them and embedding run as separate stages
+        # connected by bounded queues, so memory stays flat however large the
+        # repo is and file I/O, splitting and embedding calls overlap.
+        def read_files():
+            for file_path in changed:
+                content = self._read_git_file(path, file_path)
+                if content is not None:
+                    yield file_path, content
+
+        def split_files(contents):
+            for file_path, content in contents:
+                texts = [text for text in self.splitter.split_text(content) if text]
+                if not texts:
+                    continue
+                print(f"Adding {file_path}")
+                files[file_path] = len(texts)
+                metadata = self._git_metadata(gh_repo, file_path)
+                ids = git_chunk_ids(gh_repo, file_path, len(texts))
+                written.update(ids)
+                for text, _id in zip(texts, ids):
+                    yield Document(page_content=text, metadata=metadata), _id
+
+        self._write_chunks(threaded_stage(split_files(threaded_stage(read_files()))))
+
+        # Chunk ids are positional, so rewritten chunks overwrite themselves in
+        # place. Only the ones nothing rewrote are deleted, and only once the
+        # new chunks are written, so the repo stays searchable during the run
+        # and a failed embedding call leaves its previous version in place.
+        stale_ids = list(dict.fromkeys(_id for _id in stale_ids if _id not in written))
+        if stale_ids:
+            self.delete_documents(stale_ids)
+
+        store_state[gh_repo] = {"commit": head, "files": files}
+        save_index_state(state)
+        self._index_updated()
         print("Done")
         return
+
+    def _repo_chunk_ids(self, gh_repo: str) -> List[str]:
+        """Ids of every stored chunk of the repo, including the ones the old
+        GitLoader ingestion wrote under random ids, so a full run leaves no
+        duplicates behind. Scans the whole store, so only full runs use it."""
+        prefix = f"https://github.com/{gh_repo}/blob/"
+        return [
+            _id
+            for _id, doc in self.document_store.iter_documents()
+            if doc.metadata.get("source", "").startswith(prefix)
+        ]
+
+    def _git_changes(self, repo, since: str, until: str):
+        changed, removed = [], []
+        for diff in repo.commit(since).diff(until):
+            if diff.change_type in ("D", "R") and diff.a_path.endswith(
+                GIT_FILE_EXTENSIONS
+            ):
+                removed.append(diff.a_path)
+            if diff.change_type != "D" and diff.b_path.endswith(GIT_FILE_EXTENSIONS):
+                changed.append(diff.b_path)
+        return changed, removed
+
+    def _read_git_file(self, repo_path: str, file_path: str) -> Optional[str]:
+        try:
+            with open(os.path.join(repo_path, file_path), encoding="utf-8") as f:
+                return f.read()
+        except (FileNotFoundError, UnicodeDecodeError):
+            return None
+
+    def _git_metadata(self, gh_repo: str, file_path: str) -> dict:
+        return {
+            "source": f"https://github.com/{gh_repo}/blob/master/{file_path}",
+            "file_path": file_path,
+            "file_name": os.path.basename(file_path),
+            "file_type": os.path.splitext(file_path)[1],
+        }
@@ -1,5 +1,9 @@
 import datetime
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
 
 from dotenv import load_dotenv
 from pdpyras import APISession, PDClientError
@@ -8,56 +12,187 @@ load_dotenv()
 
 
 api_key = os.environ.get('PD_API_KEY')
-session = APISession(api_key, default_from="max.ai@posthog.com")
 
+# Schedules per oncalls request, sent as repeated schedule_ids[] parameters
+PD_SCHEDULES_PER_REQUEST = int(os.getenv("PD_SCHEDULES_PER_REQUEST", 25))
+# Concurrent requests when fetching the remaining pages of a listing
+PD_WORKERS = int(os.getenv("PD_WORKERS", 4))
+# How often the on-call snapshot is refreshed, in seconds
+PD_ONCALL_TTL = float(os.getenv("PD_ONCALL_TTL", 300))
+
+PAGE_LIMIT = 100  # Maximum limit allowed by PagerDuty API
+
+_session = None
+
+
+def get_session():
+    global _session
+    if _session is None:
+        _session = APISession(api_key, default_from="max.ai@posthog.com")
+    return _session
+
+
+def set_session(session):
+    """Replaces the PagerDuty API session, e.g. with a stub in tests. It only
+    needs a get(path, params=...) returning a response with .ok, .status_code
+    and .json()."""
+    global _session
+    _session = session
+
+
+def get_page(path: str, key: str, params: dict) -> dict:
+    """One page of a listing. Raises PDClientError on an error response or a
+    body without the listing, so failures aren't mistaken for no results."""
+    response = get_session().get(path, params=params)
+    if not response.ok:
+        raise PDClientError(f"GET {path} returned HTTP {response.status_code}", response)
+    page = response.json()
+    if key not in page:
+        raise PDClientError(f"GET {path} returned no {key}", response)
+    return page
+
+
+def get_all_pages(path: str, key: str, params: Optional[dict] = None) -> List[dict]:
+    """Fetches every item of a paginated listing. The first page asks for the
+    total, and the remaining pages are requested in parallel."""
+    params = {**(params or {}), "limit": PAGE_LIMIT}
+    first = get_page(path, key, {**params, "offset": 0, "total": "true"})
+    items = list(first[key])
+    if not first.get("more"):
+        return items
+
+    total = first.get("total")
+    if total is None:
+        # No total to plan from, walk the pages one by one
+        offset = PAGE_LIMIT
+        while True:
+            page = get_page(path, key, {**params, "offset": offset})
+            items += page[key]
+            if not page.get("more"):
+                return items
+            offset += PAGE_LIMIT
+
+    def fetch(offset):
+        return get_page(path, key, {**params, "offset": offset})[key]
+
+    with ThreadPoolExecutor(max_workers=PD_WORKERS) as pool:
+        for page in pool.map(fetch, range(PAGE_LIMIT, total, PAGE_LIMIT)):
+            items += page
+    return items
 
-def get_all_schedule_ids_and_names():
-    schedules = []
-    offset = 0
-    limit = 100  # Maximum limit allowed by PagerDuty API
-    while True:
-        try:
-            response = session.get("schedules", params={"limit": limit, "offset": offset}).json()
-            if not response.get("schedules", []):
-                break
-
-            for schedule in response["schedules"]:
-                schedules.append((schedule["id"], schedule["summary"]))
-
-            offset += limit
-        except PDClientError as e:
-            print(f"Error: {e}")
-            break
-
-    return schedules
-
-
-def get_current_oncalls(schedule_id):
-    try:
-        oncalls = session.get("oncalls", params={
-            "schedule_ids[]": schedule_id,
-            "since": datetime.datetime.now().isoformat(),
-            "until": datetime.datetime.now().isoformat()
-        }).json()
 
-        return [oncall['user'] for oncall in oncalls['oncalls']]
-    except PDClientError as e:
-        print(f"Error: {e}")
-        return []
+def get_all_schedule_ids_and_names():
+    return [(schedule["id"], schedule["summary"]) for schedule in get_all_pages("schedules", "schedules")]
+
+
+def get_current_oncalls(schedule_ids: List[str]) -> Dict[str, List[dict]]:
+    """Users currently on call per schedule id, for many schedules per request."""
+    now = datetime.datetime.now().isoformat()
+    batches = [
+        schedule_ids[start : start + PD_SCHEDULES_PER_REQUEST]
+        for start in range(0, len(schedule_ids), PD_SCHEDULES_PER_REQUEST)
+    ]
+
+    def fetch(batch):
+        return get_all_pages("oncalls", "oncalls", params={
+            "schedule_ids[]": batch,
+            "since": now,
+            "until": now
+        })
+
+    users = {}
+    with ThreadPoolExecutor(max_workers=PD_WORKERS) as pool:
+        for oncalls in pool.map(fetch, batches):
+            for oncall in oncalls:
+                schedule = oncall.get("schedule") or {}
+                schedule_users = users.setdefault(schedule.get("id"), [])
+                # Someone on call at several escalation levels is listed once
+                if oncall["user"] not in schedule_users:
+                    schedule_users.append(oncall["user"])
+    return users
 
 
 def current_oncalls():
-    oncalls = {} 
-    for schedule_id, schedule_name in get_all_schedule_ids_and_names():
-        oncall_users = get_current_oncalls(schedule_id)
+    schedules = get_all_schedule_ids_and_names()
+    users = get_current_oncalls([schedule_id for schedule_id, _ in schedules])
+    oncalls = {}
+    for schedule_id, schedule_name in schedules:
+        oncall_users = users.get(schedule_id, [])
         if len(oncall_users) < 1:
-            continue 
+            continue
         oncalls[schedule_name] = []
         for user in oncall_users:
             summary = user.get('summary', 'no summary')
-            user.get('email', 'no email')
             oncalls[schedule_name].append(summary)
-    return oncalls 
+    return oncalls
+
+
+class OncallCache:
+    """Latest on-call snapshot, refreshed in the background every `ttl` seconds.
+
+    get() never waits on PagerDuty: it returns the last snapshot (empty until
+    the first fetch completes) and, if that is older than `ttl` and no
+    refresher thread is running, starts a refresh in the background. A failed
+    refresh keeps the previous snapshot, since an outage is when people ask.
+    """
+
+    def __init__(self, fetch: Callable[[], dict] = current_oncalls, ttl: float = PD_ONCALL_TTL):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.snapshot = {}
+        self.fetched_at = None
+        self.lock = threading.Lock()
+        self.refreshing = False
+        self.thread = None
+
+    def refresh(self) -> dict:
+        try:
+            snapshot = self.fetch()
+        except Exception as e:
+            print(f"Error refreshing on-calls: {e}")
+            return self.snapshot
+        with self.lock:
+            self.snapshot = snapshot
+            self.fetched_at = time.monotonic()
+        return snapshot
+
+    def _refresh_in_background(self):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                self.refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def is_stale(self) -> bool:
+        return self.fetched_at is None or time.monotonic() - self.fetched_at > self.ttl
+
+    def get(self) -> dict:
+        if self.is_stale() and self.thread is None:
+            self._refresh_in_background()
+        return self.snapshot
+
+    def start(self):
+        """Keeps the snapshot fresh from a daemon thread."""
+        if self.thread is not None:
+            return
+
+        def run():
+            while True:
+                self.refresh()
+                time.sleep(self.ttl)
+
+        self.thread = threading.Thread(target=run, name="oncall-refresh", daemon=True)
+        self.thread.start()
+
+
+oncall_cache = OncallCache()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,56 @@
+import threading
+from typing import Dict, List, Tuple
+
+from pipeline import get_encoding
+
+
+class PromptRegistry:
+    """Static prompt fragments with their token counts computed once.
+
+    Modules register their prompt constants at import time, and warm() (run
+    when the server warms up) tokenizes them all. Counts are keyed by text, so
+    count() and assemble() find a registered fragment in a dict lookup instead
+    of re-encoding it, and only the dynamic parts of a prompt are tokenized
+    per request.
+    """
+
+    def __init__(self):
+        self.fragments: Dict[str, str] = {}
+        self.static = set()
+        self.counts: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def register(self, name: str, text: str) -> str:
+        self.fragments[name] = text
+        self.static.add(text)
+        return text
+
+    def warm(self):
+        for text in list(self.fragments.values()):
+            self.count(text)
+
+    def count(self, text: str) -> int:
+        tokens = self.counts.get(text)
+        if tokens is None:
+            tokens = len(get_encoding().encode(text, disallowed_special=()))
+            if text in self.static:
+                with self.lock:
+                    self.counts[text] = tokens
+        return tokens
+
+    def assemble(self, *parts: str) -> Tuple[str, int]:
+        """Joins prompt parts and returns the text with its token count.
+
+        The count is the sum of the parts' counts. BPE can merge tokens across
+        a boundary, so it may exceed the exact count by about one token per
+        part, which errs on the safe side for budgeting.
+        """
+        return "".join(parts), sum(self.count(part) for part in parts)
+
+    def report(self) -> List[Tuple[str, int, int]]:
+        """(name, tokens, characters) for every registered fragment, largest first."""
+        rows = [(name, self.count(text), len(text)) for name, text in self.fragments.items()]
+        return sorted(rows, key=lambda row: -row[1])
+
+
+registry = PromptRegistry()
@@ -3,19 +3,12 @@ import uuid
 
 import requests
 from dotenv import load_dotenv
-from haystack import Document
-from weaviate.util import generate_uuid5
 
-from pipeline import MaxPipeline, split_markdown_sections
+from pipeline import Entries, get_pipeline
 
 load_dotenv()  # take environment variables from .env.
 
 
-pipeline = MaxPipeline(
-    openai_token=os.getenv("OPENAI_TOKEN")
-)
-
-
 def get_uuid(content):
     return str(uuid.uuid5(uuid.NAMESPACE_URL, content))
 
@@ -51,13 +44,7 @@ def embed_docs_with_api(docs):
 
 
 def embed_docs_directly(docs):
-    for entry in docs['entries']:
-        headings = split_markdown_sections(entry['content'])
-
-        documents = [Document(id=generate_uuid5(doc), content=doc, content_type='text', meta=entry['meta']) for doc in headings if doc]
-        pipeline.embed_documents(documents)
-
-    pipeline.update_embeddings()
+    get_pipeline().embed_markdown_document(Entries(**docs))
 
     return []
 
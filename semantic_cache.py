@@ -0,0 +1,103 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+
+from mmr import normalize_rows
+
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.95))
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", 512))
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", 24 * 3600))
+
+
+class SemanticCache:
+    """Answers keyed by question embedding and the set of retrieved documents.
+
+    A lookup hits when a cached question is at least `threshold` cosine similar to
+    the new one and retrieval returned exactly the same documents for both, so an
+    answer is never reused once the underlying docs change.
+    """
+
+    def __init__(
+        self,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        max_size: int = SEMANTIC_CACHE_SIZE,
+        ttl: float = SEMANTIC_CACHE_TTL,
+    ):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.next_key = 0
+        self.matrix = None
+        self.matrix_keys = []
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, vector: List[float], doc_ids: List[str]) -> Optional[str]:
+        query = normalize_rows(np.asarray(vector, dtype=np.float32))
+        doc_ids = frozenset(doc_ids)
+        with self.lock:
+            self._expire()
+            if self.entries:
+                matrix, keys = self._matrix()
+                scores = matrix @ query
+                for i in np.argsort(-scores):
+                    if scores[i] < self.threshold:
+                        break
+                    entry = self.entries[keys[i]]
+                    if entry["doc_ids"] == doc_ids:
+                        self.entries.move_to_end(keys[i])
+                        self.hits += 1
+                        return entry["answer"]
+            self.misses += 1
+            return None
+
+    def add(self, vector: List[float], doc_ids: List[str], answer: str):
+        with self.lock:
+            self.entries[self.next_key] = {
+                "vector": normalize_rows(np.asarray(vector, dtype=np.float32)),
+                "doc_ids": frozenset(doc_ids),
+                "answer": answer,
+                "expires": time.monotonic() + self.ttl,
+            }
+            self.next_key += 1
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            self.matrix = None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.matrix = None
+        print("Semantic cache cleared")
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def _expire(self):
+        now = time.monotonic()
+        expired = [key for key, entry in self.entries.items() if entry["expires"] < now]
+        for key in expired:
+            del self.entries[key]
+        if expired:
+            self.matrix = None
+
+    def _matrix(self):
+        if self.matrix is None:
+            self.matrix_keys = list(self.entries.keys())
+            self.matrix = np.stack(
+                [self.entries[key]["vector"] for key in self.matrix_keys]
+            )
+        return self.matrix, self.matrix_keys
@@ -1,18 +1,33 @@
+import asyncio
 import os
+import time
 import traceback
 
 from dotenv import load_dotenv
 from slack_bolt.async_app import AsyncApp
 from slack_bolt.oauth.async_oauth_settings import AsyncOAuthSettings
+from slack_sdk.errors import SlackApiError
 from slack_sdk.oauth.installation_store import FileInstallationStore
 from slack_sdk.oauth.state_store import FileOAuthStateStore
 
-from ai import ai_chat_thread, summarize_thread
-from inference import get_query_response
+from ai import ai_chat_thread, ai_chat_thread_stream, summarize_thread
+from oncall_router import answer_oncall_question
+from slack_jobs import jobs, seen_events
 from posthog import Posthog
 
 CHAT_HISTORY_LIMIT = 20
 
+# Mentions are answered with a placeholder message that is edited as the
+# response streams in, at most once every SLACK_UPDATE_INTERVAL seconds.
+SLACK_STREAM_RESPONSES = os.getenv("SLACK_STREAM_RESPONSES", "true").lower() == "true"
+SLACK_UPDATE_INTERVAL = float(os.getenv("SLACK_UPDATE_INTERVAL", 1.0))
+# How often the final edit is retried when chat.update is rate limited
+SLACK_UPDATE_RETRIES = int(os.getenv("SLACK_UPDATE_RETRIES", 3))
+
+# Answer feature flag and experiment questions from the dedicated feature flag
+# prompt, as picked by the local classifier in classification.py.
+QUESTION_ROUTING = os.getenv("QUESTION_ROUTING", "false").lower() == "true"
+
 load_dotenv()
 
 posthog = Posthog(os.environ.get("POSTHOG_API_KEY"), os.environ.get("POSTHOG_HOST"))
@@ -63,6 +78,33 @@ app = AsyncApp(
     signing_secret=os.environ.get("SLACK_SIGNING_SECRET"),
 )
 
+@app.middleware
+async def skip_duplicate_events(body, req, resp, next):
+    """Acknowledges redelivered events without running them again.
+
+    Slack redelivers an event, with X-Slack-Retry-Num and -Reason headers,
+    when it got no timely 200 for it. Every listener acknowledges right away
+    and does its work on the job queue, so a retry after an http_timeout is a
+    duplicate of an event some worker already took, and is dropped whichever
+    worker it lands on. Retries after an http_error or connection_failed,
+    e.g. a proxy 502 during a deploy, may be the first delivery any worker
+    sees, so they are only checked against the event ids remembered per
+    process.
+    """
+    event_id = body.get("event_id")
+    retry_num = (req.headers.get("x-slack-retry-num") or [None])[0]
+    retry_reason = (req.headers.get("x-slack-retry-reason") or [None])[0]
+    if retry_num and retry_reason == "http_timeout":
+        jobs.counts["retries"] += 1
+        print(f"Skipping retried event {event_id} (retry {retry_num}, {retry_reason})")
+        return resp
+    if event_id and not seen_events.add(event_id):
+        jobs.counts["duplicates"] += 1
+        print(f"Skipping duplicate event {event_id}")
+        return resp
+    await next()
+
+
 # Add functionality here
 # @app.event("app_home_opened") etc
 @app.event("app_home_opened")
@@ -115,12 +157,26 @@ async def handle_summarize_slash_command(ack, say, command):
 
 @app.event("message")
 async def handle_message_events(client, body, logger, say):
+    # Bolt has acknowledged the event by now, the answer is worked out on the job queue
+    if not jobs.submit("message", _handle_message_events, client, body, logger, say):
+        # Slack's redelivery would be dropped as a duplicate, so let DMs know
+        if body["event"].get("channel_type") == "im":
+            await send_message(say, text="I'm a little over capacity right now. Please try again in a few minutes! :sleeping-hog:")
+
+
+async def _handle_message_events(client, body, logger, say):
     event_type = body["event"]["channel_type"]
     event = body["event"]
     bot_id = body['authorizations'][0]['user_id']
     print(body) 
 
     if event_type == "im":
+        # message_changed and message_deleted events carry no text
+        oncall_answer = answer_oncall_question(event.get("text", ""))
+        if oncall_answer:
+            await send_message(say, oncall_answer)
+            return
+
         thread = await client.conversations_history(channel=event["channel"], limit=CHAT_HISTORY_LIMIT)
         thread = preprocess_slack_thread(bot_id, thread)
         response = await ai_chat_thread(thread)
@@ -160,6 +216,8 @@ async def handle_message_events(client, body, logger, say):
             # we just responded, don't respond to ourselves
             return
         
+        from inference import get_query_response
+
         # get first message in thread
         question = thread[0]["content"]
         response = get_query_response(question, thread)
@@ -173,12 +231,19 @@ async def handle_emoji_changed_events(body, logger, say):
 
 @app.event("app_mention")
 async def handle_app_mention_events(client, body, logger, say):
+    if not jobs.submit("app_mention", answer_app_mention, client, body, logger, say):
+        await send_message(say, text="I'm a little over capacity right now. Please try again in a few minutes! :sleeping-hog:")
+
+
+async def answer_app_mention(client, body, logger, say):
     try:
         await _handle_app_mention_events(client, body, logger, say)
     except Exception as e:
         traceback.print_exc()
 
-        await send_message(say, text="I'm a little over capacity right now. Please try again in a few minutes! :sleeping-hog:")
+        # A streamed answer already shows the error in its placeholder
+        if not isinstance(e, StreamFailed):
+            await send_message(say, text="I'm a little over capacity right now. Please try again in a few minutes! :sleeping-hog:")
 
         posthog.capture(
             "max-ai",
@@ -215,24 +280,100 @@ async def _handle_app_mention_events(client, body, logger, say):
     )
     if "please summarize this" in event["text"].lower():
         await send_message(say, text="On it!", thread_ts=thread_ts, user_id=user_id, thread=thread)
-        summary = summarize_thread(thread)
+        summary = await summarize_thread(thread)
         await send_message(say, text=summary, thread_ts=thread_ts, user_id=user_id, thread=thread)
         return
     
     thread = preprocess_slack_thread(bot_id, thread)
 
-    # first_relevant_message = thread[0]["content"]
-    # Disabling this for launch because it can be confusing and jarring when these are incorrect
-    # use_feature_flag_prompt = await classify_question(first_relevant_message)
-    # if use_feature_flag_prompt:
-    #     print("using feature flag prompt for ", first_relevant_message)
-    #     response = await get_query_response(first_relevant_message, thread[1:])
-    #     await send_message(say, text=response, thread_ts=thread_ts, user_id=user_id, thread=thread)
-    #     return
+    oncall_answer = answer_oncall_question(event["text"])
+    if oncall_answer:
+        await send_message(say, text=oncall_answer, thread_ts=thread_ts, user_id=user_id, thread=thread)
+        return
+
+    # Disabled by default since launch because it can be confusing and jarring when these are incorrect
+    if QUESTION_ROUTING:
+        from classification import classify_question
+        from inference import get_query_response
+
+        first_relevant_message = thread[0]["content"]
+        use_feature_flag_prompt = await classify_question(first_relevant_message)
+        if use_feature_flag_prompt:
+            print("using feature flag prompt for ", first_relevant_message)
+            response = await get_query_response(first_relevant_message, thread[1:])
+            await send_message(say, text=response, thread_ts=thread_ts, user_id=user_id, thread=thread)
+            return
     
+    if SLACK_STREAM_RESPONSES:
+        await stream_message(
+            client,
+            ai_chat_thread_stream(thread),
+            channel=event["channel"],
+            thread_ts=thread_ts,
+            user_id=user_id,
+            thread=thread,
+        )
+        return
+
     response = await ai_chat_thread(thread)
     await send_message(say, text=response, thread_ts=thread_ts, user_id=user_id, thread=thread)
 
+class StreamFailed(Exception):
+    """Raised by stream_message once its placeholder shows the error."""
+
+
+def retry_after(e: SlackApiError):
+    """Seconds to wait before calling again if e is a rate limit error, else None."""
+    if e.response.get("error") != "ratelimited":
+        return None
+    return float(e.response.headers.get("Retry-After", SLACK_UPDATE_INTERVAL))
+
+
+async def update_message(client, channel, ts, text):
+    """Edits a message, waiting out chat.update rate limits a few times."""
+    for attempt in range(SLACK_UPDATE_RETRIES + 1):
+        try:
+            return await client.chat_update(channel=channel, ts=ts, text=text)
+        except SlackApiError as e:
+            delay = retry_after(e)
+            if delay is None or attempt == SLACK_UPDATE_RETRIES:
+                raise
+            await asyncio.sleep(delay)
+
+
+async def stream_message(client, chunks, channel, thread_ts, user_id=None, thread=None):
+    placeholder = await client.chat_postMessage(
+        channel=channel, thread_ts=thread_ts, text="_Thinking..._ :hog-excited:"
+    )
+    text = ""
+    next_update = time.monotonic() + SLACK_UPDATE_INTERVAL
+    try:
+        async for chunk in chunks:
+            text += chunk
+            if time.monotonic() < next_update:
+                continue
+            next_update = time.monotonic() + SLACK_UPDATE_INTERVAL
+            try:
+                await client.chat_update(channel=channel, ts=placeholder["ts"], text=text)
+            except SlackApiError as e:
+                # chat.update allows about 50 calls a minute, shared by every
+                # streaming job. A skipped edit is carried by the next one.
+                delay = retry_after(e)
+                if delay is None:
+                    raise
+                next_update = time.monotonic() + delay
+        await update_message(client, channel, placeholder["ts"], text)
+    except Exception as e:
+        await update_message(
+            client,
+            channel,
+            placeholder["ts"],
+            "I'm a little over capacity right now. Please try again in a few minutes! :sleeping-hog:",
+        )
+        raise StreamFailed(str(e)) from e
+
+    posthog.capture("max-ai", "max-ai message sent", {"message": text, "thread_ts": thread_ts, "sender": user_id, "context": thread})
+
 async def send_message(say, text, thread_ts=None, user_id=None, thread=None):
     posthog.capture("max-ai", "max-ai message sent", {"message": text, "thread_ts": thread_ts, "sender": user_id, "context": thread})
 
@@ -0,0 +1,121 @@
+import asyncio
+import os
+import threading
+import time
+import traceback
+from collections import Counter, OrderedDict, deque
+
+import numpy as np
+
+# Slack event handlers run as jobs on SLACK_JOB_WORKERS workers per process,
+# with up to SLACK_JOB_QUEUE_SIZE more waiting their turn.
+SLACK_JOB_WORKERS = int(os.getenv("SLACK_JOB_WORKERS", 8))
+SLACK_JOB_QUEUE_SIZE = int(os.getenv("SLACK_JOB_QUEUE_SIZE", 256))
+# How long event ids are remembered to drop Slack's redelivery of an event
+SLACK_EVENT_DEDUP_TTL = float(os.getenv("SLACK_EVENT_DEDUP_TTL", 3600))
+SLACK_EVENT_DEDUP_SIZE = int(os.getenv("SLACK_EVENT_DEDUP_SIZE", 10000))
+
+
+class SeenEvents:
+    """Event ids seen in the last `ttl` seconds, at most `max_size` of them."""
+
+    def __init__(self, ttl: float = SLACK_EVENT_DEDUP_TTL, max_size: int = SLACK_EVENT_DEDUP_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, event_id: str) -> bool:
+        """Records the id, returning False if it was already seen."""
+        now = time.monotonic()
+        with self.lock:
+            while self.entries and next(iter(self.entries.values())) < now:
+                self.entries.popitem(last=False)
+            if event_id in self.entries:
+                return False
+            self.entries[event_id] = now + self.ttl
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            return True
+
+
+class JobQueue:
+    """In-process queue of async jobs with bounded concurrency.
+
+    Jobs are (coroutine function, args) pairs so a dropped job never creates
+    a coroutine. The asyncio queue and workers belong to the event loop of the
+    first submit(), and are recreated if a later one comes from another loop.
+    """
+
+    def __init__(self, workers: int = SLACK_JOB_WORKERS, maxsize: int = SLACK_JOB_QUEUE_SIZE):
+        self.workers = workers
+        self.maxsize = maxsize
+        self.queue = None
+        self.loop = None
+        self.tasks = []
+        self.running = 0
+        self.counts = Counter()
+        self.wait_times = deque(maxlen=1000)
+        self.run_times = deque(maxlen=1000)
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.queue = asyncio.Queue(self.maxsize)
+            self.tasks = [loop.create_task(self._work()) for _ in range(self.workers)]
+
+    def submit(self, name: str, func, *args) -> bool:
+        """Queues func(*args), returning False if the queue is full."""
+        self._ensure_started()
+        try:
+            self.queue.put_nowait((name, func, args, time.monotonic()))
+        except asyncio.QueueFull:
+            self.counts["dropped"] += 1
+            print(f"Slack job queue is full, dropping {name}")
+            return False
+        self.counts["enqueued"] += 1
+        return True
+
+    async def _work(self):
+        while True:
+            name, func, args, enqueued_at = await self.queue.get()
+            started_at = time.monotonic()
+            self.wait_times.append(started_at - enqueued_at)
+            self.running += 1
+            try:
+                await func(*args)
+                self.counts["completed"] += 1
+            except Exception:
+                self.counts["failed"] += 1
+                print(f"Slack job {name} failed")
+                traceback.print_exc()
+            finally:
+                self.running -= 1
+                self.run_times.append(time.monotonic() - started_at)
+                self.queue.task_done()
+
+    def stats(self) -> dict:
+        def percentiles(times):
+            if not times:
+                return None
+            times = np.array(times) * 1000
+            return {
+                "p50": float(np.percentile(times, 50)),
+                "p95": float(np.percentile(times, 95)),
+                "max": float(times.max()),
+            }
+
+        return {
+            "depth": self.queue.qsize() if self.queue else 0,
+            "running": self.running,
+            "workers": self.workers,
+            "max_depth": self.maxsize,
+            **self.counts,
+            "wait_ms": percentiles(self.wait_times),
+            "run_ms": percentiles(self.run_times),
+        }
+
+
+jobs = JobQueue()
+seen_events = SeenEvents()
@@ -0,0 +1,115 @@
+import pytest
+from langchain.docstore.document import Document
+
+import context_packer
+import prompt_registry
+from context_packer import ContextPacker, count_message_tokens
+
+
+class WordEncoding:
+    """One token per space-separated word, so budgets are easy to reason about."""
+
+    def encode(self, text, disallowed_special=()):
+        return text.split(" ")
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+@pytest.fixture(autouse=True)
+def word_encoding(monkeypatch):
+    monkeypatch.setattr(context_packer, "get_encoding", WordEncoding)
+    monkeypatch.setattr(prompt_registry, "get_encoding", WordEncoding)
+    monkeypatch.setattr(prompt_registry.registry, "counts", {})
+
+
+def words(count, word="word"):
+    return " ".join([word] * count)
+
+
+def message(role, count, word="word"):
+    return {"role": role, "content": words(count, word)}
+
+
+def documents(count, size):
+    return [
+        Document(page_content=words(size, f"doc{i}"), metadata={"source": f"s{i}"})
+        for i in range(count)
+    ]
+
+
+def check_budget(packer, packed):
+    assert packed.tokens_used <= packer.budget
+    assert count_message_tokens(packed.messages) <= packer.budget
+
+
+def test_everything_fits():
+    packer = ContextPacker("gpt-4", max_context_tokens=2000, completion_tokens=0)
+    thread = [message("user", 20), message("assistant", 50), message("user", 10, "latest")]
+    packed = packer.pack("system", documents(4, 100), thread)
+
+    check_budget(packer, packed)
+    assert packed.tokens_dropped == 0
+    assert len(packed.documents) == 4
+    assert packed.messages[2:] == thread[1:]
+
+
+def test_follow_ups_use_what_documents_leave():
+    packer = ContextPacker(
+        "gpt-4", max_context_tokens=2000, completion_tokens=0, thread_share=0.1
+    )
+    # Well over thread_share of the budget, but the documents are small
+    thread = [message("user", 20)] + [
+        message("assistant" if i % 2 else "user", 300) for i in range(4)
+    ] + [message("user", 10, "latest")]
+    packed = packer.pack("system", documents(4, 50), thread)
+
+    check_budget(packer, packed)
+    assert len(packed.documents) == 4
+    assert packed.messages[2:] == thread[1:]
+
+
+def test_thread_share_is_held_back_from_documents():
+    packer = ContextPacker(
+        "gpt-4", max_context_tokens=2000, completion_tokens=0, thread_share=0.3
+    )
+    thread = [message("user", 20), message("assistant", 300), message("user", 10, "latest")]
+    packed = packer.pack("system", documents(10, 500), thread)
+
+    check_budget(packer, packed)
+    assert packed.messages[2:] == thread[1:]
+    assert len(packed.documents) < 10
+
+
+def test_latest_message_is_kept_when_it_alone_is_over_the_share():
+    packer = ContextPacker(
+        "gpt-4", max_context_tokens=2000, completion_tokens=0, thread_share=0.1
+    )
+    thread = [message("user", 20), message("assistant", 50), message("user", 800, "latest")]
+    packed = packer.pack("system", documents(4, 100), thread)
+
+    check_budget(packer, packed)
+    assert packed.messages[-1] == thread[-1]
+    assert "latest message" not in packed.truncated
+
+
+def test_latest_message_is_truncated_rather_than_dropped():
+    packer = ContextPacker("gpt-4", max_context_tokens=500, completion_tokens=0)
+    thread = [message("user", 20), message("assistant", 50), message("user", 5000, "latest")]
+    packed = packer.pack("system", documents(4, 100), thread)
+
+    check_budget(packer, packed)
+    assert packed.messages[-1]["role"] == "user"
+    assert packed.messages[-1]["content"].startswith("latest latest")
+    assert "latest message" in packed.truncated
+    assert "first message" not in packed.truncated
+    assert packed.messages[1]["content"].endswith(words(20))
+
+
+def test_first_message_is_truncated_when_it_overflows_alone():
+    packer = ContextPacker("gpt-4", max_context_tokens=500, completion_tokens=0)
+    packed = packer.pack("system", documents(2, 100), [message("user", 5000)])
+
+    check_budget(packer, packed)
+    assert packed.truncated == ["first message"]
+    assert packed.documents == []
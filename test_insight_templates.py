@@ -0,0 +1,75 @@
+import pytest
+
+from definition_index import Definition
+from insight_templates import InsightTemplateMatcher
+
+
+@pytest.fixture(scope="module")
+def matcher():
+    return InsightTemplateMatcher(
+        [
+            Definition("$pageview", "event"),
+            Definition("user signed up", "event"),
+            Definition("recording viewed", "event"),
+            Definition("$browser", "property"),
+            Definition("$geoip_country_code", "property"),
+        ]
+    )
+
+
+def test_trend_with_interval_date_range_and_breakdown(matcher):
+    match = matcher.match("show me pageviews per week over the last 30 days by browser")
+    assert match.confidence == 1
+    assert match.insight == {
+        "insight": "TRENDS",
+        "interval": "week",
+        "events": [{"name": "$pageview", "type": "events", "order": 0}],
+        "date_from": "-30d",
+        "breakdown": "$browser",
+        "breakdown_type": "event",
+    }
+
+
+def test_active_users_default_to_pageviews(matcher):
+    match = matcher.match("daily active users excluding internal and test users")
+    assert match.insight["events"] == [
+        {"name": "$pageview", "type": "events", "order": 0, "math": "dau"}
+    ]
+    assert match.insight["filter_test_accounts"] is True
+    # "daily" is read as part of the math, not as the interval
+    assert match.insight["interval"] == "day"
+
+
+def test_funnel_needs_two_events(matcher):
+    match = matcher.match("funnel from pageview to sign up")
+    assert match.insight["insight"] == "FUNNELS"
+    assert [event["name"] for event in match.insight["events"]] == [
+        "$pageview",
+        "user signed up",
+    ]
+    assert matcher.match("conversion of sign ups") is None
+
+
+def test_display_and_aliases(matcher):
+    match = matcher.match("number of signups as a pie chart by country")
+    assert match.insight["display"] == "ActionsPie"
+    assert match.insight["breakdown"] == "$geoip_country_code"
+    assert match.insight["events"][0]["name"] == "user signed up"
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "unique users who did not sign up",
+        "count of recording viewed per hour today",
+        "pageviews since january",
+        "how do I invite my team",
+    ],
+)
+def test_requests_the_rules_cant_represent_fall_through(matcher, query):
+    assert matcher.match(query) is None
+
+
+def test_unexplained_words_lower_the_confidence(matcher):
+    match = matcher.match("pageviews from customers on the enterprise plan")
+    assert match.confidence < 0.75
@@ -0,0 +1,41 @@
+from langchain.docstore.document import Document
+
+import lexical_index
+from lexical_index import BM25Index
+
+
+def test_persist_keeps_deletes_from_other_workers(tmp_path):
+    path = str(tmp_path / "lexical_index.json")
+    first = BM25Index(path)
+    second = BM25Index(path)
+
+    first.add([Document(page_content="alpha"), Document(page_content="beta")], ["a", "b"])
+    first.persist()
+    second.refresh()
+    assert second.changed == set()
+
+    first.delete(["b"])
+    first.persist()
+    assert second.search("beta") == []
+
+    second.add([Document(page_content="gamma")], ["c"])
+    second.persist()
+    assert sorted(BM25Index.load(path).positions) == ["a", "c"]
+
+
+def test_workers_apply_segments_and_base_rewrites(tmp_path, monkeypatch):
+    monkeypatch.setattr(lexical_index, "LEXICAL_INDEX_MAX_SEGMENTS", 2)
+    path = str(tmp_path / "lexical_index.json")
+    first = BM25Index(path)
+    second = BM25Index.load(path)
+
+    for number, word in enumerate(["alpha", "beta", "gamma", "delta"]):
+        first.add([Document(page_content=word)], [word])
+        if number == 2:
+            first.delete(["alpha"])
+        first.persist()
+        assert [_id for _, _id, _ in second.search(word)] == [word]
+
+    assert second.search("alpha") == []
+    assert second.generation == first.generation == 2
+    assert sorted(BM25Index.load(path).positions) == ["beta", "delta", "gamma"]
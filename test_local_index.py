@@ -0,0 +1,51 @@
+from langchain.docstore.document import Document
+
+from local_index import LocalDocumentStore
+
+
+def add(store, *ids):
+    store.add_vectors(
+        [Document(page_content=_id) for _id in ids],
+        [[1.0, float(i)] for i, _ in enumerate(ids)],
+        list(ids),
+    )
+
+
+def test_persist_keeps_deletes_from_other_workers(tmp_path):
+    first = LocalDocumentStore(None, path=str(tmp_path))
+    second = LocalDocumentStore(None, path=str(tmp_path))
+
+    add(first, "x")
+    first.persist()
+    # Written as a segment, which second applies on top of the base
+    add(first, "w")
+    first.persist()
+    second.refresh()
+    assert second.changed == set()
+
+    first.delete_ids(["w"])
+    first.persist()
+    add(second, "z")
+    second.persist()
+
+    assert sorted(LocalDocumentStore.load(None, path=str(tmp_path)).ids) == ["x", "z"]
+    assert sorted(second.ids) == ["x", "z"]
+
+
+def test_deletes_on_an_empty_store_are_persisted(tmp_path):
+    first = LocalDocumentStore(None, path=str(tmp_path))
+    second = LocalDocumentStore(None, path=str(tmp_path))
+    third = LocalDocumentStore(None, path=str(tmp_path))
+
+    first.delete_ids(["q"])
+    first.persist()
+    add(second, "q")
+    second.persist()
+    third.delete_ids(["gone"])
+    third.persist()
+
+    first.refresh()
+    add(first, "r")
+    first.persist()
+
+    assert sorted(LocalDocumentStore.load(None, path=str(tmp_path)).ids) == ["q", "r"]
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+from langchain.vectorstores.utils import maximal_marginal_relevance as reference_mmr
+
+from mmr import maximal_marginal_relevance
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("lambda_mult", [0.0, 0.25, 0.5, 0.9, 1.0])
+@pytest.mark.parametrize("k", [1, 4, 20])
+def test_matches_langchain(seed, lambda_mult, k):
+    rng = np.random.default_rng(seed)
+    query = rng.normal(size=32)
+    candidates = rng.normal(size=(20, 32)) * rng.uniform(0.5, 2, size=(20, 1))
+
+    assert maximal_marginal_relevance(
+        query, candidates, k=k, lambda_mult=lambda_mult
+    ) == reference_mmr(query, list(candidates), lambda_mult=lambda_mult, k=k)
+
+
+def test_skips_near_duplicates():
+    query = np.array([1.0, 0.0])
+    candidates = np.array([[1.0, 0.1], [1.0, 0.11], [0.5, 1.0]])
+    assert maximal_marginal_relevance(query, candidates, k=2, lambda_mult=0.3) == [0, 2]
+    assert maximal_marginal_relevance(query, candidates, k=2, lambda_mult=1) == [0, 1]
+
+
+def test_relevance_overrides_query_similarity():
+    candidates = np.eye(3)
+    relevance = np.array([0.1, 0.9, 0.5])
+    assert maximal_marginal_relevance(
+        None, candidates, k=3, relevance=relevance
+    ) == [1, 2, 0]
+
+
+def test_empty_and_zero_k():
+    assert maximal_marginal_relevance(np.ones(2), np.zeros((0, 2))) == []
+    assert maximal_marginal_relevance(np.ones(2), np.eye(2), k=0) == []
@@ -0,0 +1,76 @@
+import sys
+import types
+
+import pytest
+
+import oncall_router
+from oncall_router import answer_oncall_question, is_oncall_question, matching_schedules
+
+ONCALLS = {
+    "Support hero": ["Ana"],
+    "Infra": ["Ben", "Cleo"],
+    "Pipeline": ["Dev"],
+}
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "who's on call?",
+        "who is the current support hero?",
+        "Who are the support heroes this week?",
+        "<@U123> who is on-call for infra?",
+        "is anyone on call right now?",
+        "does anybody know today's on call?",
+    ],
+)
+def test_oncall_questions(text):
+    assert is_oncall_question(text)
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "who uses the on-call rotation feature in pagerduty?",
+        "who should I talk to about deploying to Heroku?",
+        "who can see my heatmaps on the heroes page?",
+        "what does the current on-call process look like?",
+        "how do I add people to on call today in pagerduty",
+        "how do I set up feature flags?",
+    ],
+)
+def test_other_questions(text):
+    assert not is_oncall_question(text)
+
+
+def test_matching_schedules_by_specific_word():
+    assert matching_schedules("who is the support hero?", ONCALLS) == {
+        "Support hero": ["Ana"]
+    }
+    assert matching_schedules("who is on call for infra?", ONCALLS) == {
+        "Infra": ["Ben", "Cleo"]
+    }
+    # Nothing but generic words, so every schedule is listed
+    assert matching_schedules("who's on call right now?", ONCALLS) == ONCALLS
+
+
+@pytest.fixture
+def oncall_cache(monkeypatch):
+    cache = types.SimpleNamespace(get=lambda: ONCALLS)
+    monkeypatch.setattr(oncall_router, "ONCALL_ROUTING", True)
+    monkeypatch.setitem(
+        sys.modules, "plugins.pagerduty", types.SimpleNamespace(oncall_cache=cache)
+    )
+    return cache
+
+
+def test_answer_lists_the_matching_schedules(oncall_cache):
+    assert answer_oncall_question("<@U123> who is on call for infra?") == (
+        "*Currently on call:*\n• *Infra*: Ben, Cleo"
+    )
+    assert answer_oncall_question("how do I set up feature flags?") is None
+
+
+def test_answer_without_a_snapshot(oncall_cache):
+    oncall_cache.get = lambda: {}
+    assert "couldn't get the on-call schedules" in answer_oncall_question("who's on call?")
@@ -0,0 +1,167 @@
+import os
+import uuid
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.vectorstores import Weaviate
+
+from mmr import maximal_marginal_relevance
+
+# Objects are flushed to Weaviate every WEAVIATE_BATCH_SIZE writes.
+WEAVIATE_BATCH_SIZE = int(os.getenv("WEAVIATE_BATCH_SIZE", 100))
+
+
+class WeaviateDocumentStore(Weaviate):
+    """Weaviate vector store with the vector-level writes MaxPipeline needs for
+    batched ingestion and upserts."""
+
+    @property
+    def identity(self) -> str:
+        """Names the index this store writes to, e.g. to key ingestion state."""
+        return f"weaviate:{os.getenv('WEAVIATE_URL')}/{self._index_name}"
+
+    def add_vectors(
+        self,
+        documents: List[Document],
+        vectors: List[List[float]],
+        ids: Optional[List[Optional[str]]] = None,
+    ) -> List[str]:
+        ids = [_id or str(uuid.uuid4()) for _id in ids or [None] * len(documents)]
+        self._client.batch.configure(batch_size=WEAVIATE_BATCH_SIZE)
+        with self._client.batch as batch:
+            for doc, vector, _id in zip(documents, vectors, ids):
+                batch.add_data_object(
+                    data_object={self._text_key: doc.page_content, **doc.metadata},
+                    class_name=self._index_name,
+                    uuid=_id,
+                    vector=vector,
+                )
+        return ids
+
+    def delete_ids(self, ids: List[str]):
+        for start in range(0, len(ids), WEAVIATE_BATCH_SIZE):
+            operands = [
+                {"path": ["id"], "operator": "Equal", "valueString": _id}
+                for _id in ids[start : start + WEAVIATE_BATCH_SIZE]
+            ]
+            self._client.batch.delete_objects(
+                class_name=self._index_name,
+                where={"operator": "Or", "operands": operands}
+                if len(operands) > 1
+                else operands[0],
+            )
+
+    def ids_where(self, key: str, values: List[str]) -> set:
+        """Ids of the objects whose `key` property equals one of `values`."""
+        ids = set()
+        for start in range(0, len(values), 50):
+            operands = [
+                {"path": [key], "operator": "Equal", "valueText": value}
+                for value in values[start : start + 50]
+            ]
+            result = (
+                self._client.query.get(self._index_name, [key])
+                .with_where(
+                    {"operator": "Or", "operands": operands}
+                    if len(operands) > 1
+                    else operands[0]
+                )
+                .with_additional(["id"])
+                .with_limit(10000)
+                .do()
+            )
+            if "errors" in result:
+                # The property doesn't exist until the first object carrying it is stored
+                if "no such prop" in str(result["errors"]):
+                    return set()
+                raise ValueError(f"Error during query: {result['errors']}")
+            # Text properties are word-tokenized, so Equal also matches values
+            # sharing the words, e.g. "docs/feature-flags/manual" for
+            # "docs/feature-flags". Keep exact matches only.
+            wanted = set(values[start : start + 50])
+            ids.update(
+                obj["_additional"]["id"]
+                for obj in result["data"]["Get"][self._index_name] or []
+                if obj.get(key) in wanted
+            )
+        return ids
+
+    def vectors_by_id(self, ids: List[str]) -> Dict[str, List[float]]:
+        """Stored vectors of the given objects, keyed by id."""
+        vectors = {}
+        for start in range(0, len(ids), 50):
+            operands = [
+                {"path": ["id"], "operator": "Equal", "valueString": _id}
+                for _id in ids[start : start + 50]
+            ]
+            result = (
+                self._client.query.get(self._index_name, [self._text_key])
+                .with_where(
+                    {"operator": "Or", "operands": operands}
+                    if len(operands) > 1
+                    else operands[0]
+                )
+                .with_additional(["id", "vector"])
+                .with_limit(len(operands))
+                .do()
+            )
+            if "errors" in result:
+                raise ValueError(f"Error during query: {result['errors']}")
+            for obj in result["data"]["Get"][self._index_name] or []:
+                vectors[obj["_additional"]["id"]] = obj["_additional"]["vector"]
+        return vectors
+
+    def search_with_vectors(self, embedding: List[float], k: int):
+        """Returns the k nearest documents and their vectors in one query."""
+        result = (
+            self._client.query.get(self._index_name, self._query_attrs)
+            .with_additional("vector")
+            .with_near_vector({"vector": embedding})
+            .with_limit(k)
+            .do()
+        )
+        if "errors" in result:
+            raise ValueError(f"Error during query: {result['errors']}")
+        docs, vectors = [], []
+        for obj in result["data"]["Get"][self._index_name]:
+            vectors.append(obj.pop("_additional")["vector"])
+            text = obj.pop(self._text_key)
+            docs.append(Document(page_content=text, metadata=obj))
+        return docs, np.array(vectors, dtype=np.float32)
+
+    def max_marginal_relevance_search_by_vector(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        **kwargs,
+    ) -> List[Document]:
+        docs, vectors = self.search_with_vectors(embedding, fetch_k)
+        selected = maximal_marginal_relevance(
+            embedding, vectors, k=k, lambda_mult=lambda_mult
+        )
+        return [docs[i] for i in selected]
+
+    def iter_documents(self, page_size: int = 500) -> Iterator[Tuple[str, Document]]:
+        """Pages through every stored object with the cursor API."""
+        after = None
+        while True:
+            query = (
+                self._client.query.get(self._index_name, self._query_attrs)
+                .with_additional(["id"])
+                .with_limit(page_size)
+            )
+            if after:
+                query = query.with_after(after)
+            objects = query.do()["data"]["Get"][self._index_name]
+            if not objects:
+                return
+            for obj in objects:
+                after = obj.pop("_additional")["id"]
+                text = obj.pop(self._text_key)
+                yield after, Document(page_content=text, metadata=obj)
+
+    def persist(self):
+        pass